@@ -40,9 +40,15 @@ Create an activity::
 """
 
 from botocore import exceptions
+from collections import abc
+from concurrent import futures
+import collections
+import functools
 import itertools
 import json
+import operator
 import threading
+import time
 import backoff
 
 from garcon import log
@@ -56,6 +62,28 @@ ACTIVITY_FAILED = 3
 
 DEFAULT_ACTIVITY_SCHEDULE_TO_START = 600  # 10 minutes
 
+# Keys of the input and of the result of a batch of instances (see
+# `Activity.execute_batch`.)
+BATCH_KEY = 'garcon.batch'
+BATCH_DURATION_KEY = 'garcon.batch_duration'
+
+# Keys of the scheduling hints a generator can add to the contexts it yields
+# (they are not part of the local context of the instances.)
+COST_KEY = 'garcon.cost'
+PRIORITY_KEY = 'garcon.priority'
+
+# Orders of the instances of an activity (see `Activity.instances`.)
+ORDER_FIFO = 'fifo'
+ORDER_LPT = 'lpt'
+
+# Interval (in seconds) between two checks of the prefetched tasks that need
+# to be heartbeated (see `PrefetchedTasks`.)
+PREFETCH_HEARTBEAT_CHECK = 1
+
+# Number of instances created in one pass (their canonical ids are calculated
+# together) when the instances are streamed.
+INSTANCES_CHUNK_SIZE = 1000
+
 
 class ActivityInstanceNotReadyException(Exception):
     """Exception when an activity instance is not ready.
@@ -67,10 +95,26 @@ class ActivityInstanceNotReadyException(Exception):
     pass
 
 
+class CyclicRequirementsException(Exception):
+    """Exception when the activities of a flow require each other.
+
+    A flow with a requirement cycle can never complete: none of the
+    activities of the cycle can be scheduled.
+    """
+
+    pass
+
+
 class ActivityInstance:
 
+    __slots__ = (
+        'activity_worker', 'execution_context', 'local_context',
+        'global_context', 'pool_size', 'cost', 'priority', '_description',
+        '_id')
+
     def __init__(
-            self, activity_worker, local_context=None, execution_context=None):
+            self, activity_worker, local_context=None, execution_context=None,
+            pool_size=None, activity_id=None, cost=None, priority=None):
         """Activity Instance.
 
         In SWF, Activity is a worker: it will get information from the context,
@@ -88,14 +132,30 @@ class ActivityInstance:
                 generators.
             execution_context (dict): the execution context of when an activity
                 will be scheduled with.
+            pool_size (int): the number of instances of the activity that
+                are created alongside this one (defaults to the pool size of
+                the activity worker.)
+            activity_id (str): the id of the instance, if it has already been
+                calculated (see `id`.)
+            cost (float): the cost hint of the instance (used to order the
+                instances.)
+            priority (int): the priority of the instance (the SWF task
+                priority.)
         """
 
         self.activity_worker = activity_worker
+        self.pool_size = pool_size
+        self.cost = cost
+        self.priority = priority
         self.execution_context = execution_context or dict()
         self.local_context = local_context or dict()
-        self.global_context = dict(
-            list(self.execution_context.items()) +
-            list(self.local_context.items()))
+
+        # The global context is a layered view: the local context takes
+        # precedence over the execution context, which is never copied.
+        self.global_context = collections.ChainMap(
+            self.local_context, self.execution_context)
+        self._description = None
+        self._id = activity_id
 
     @property
     def activity_name(self):
@@ -119,19 +179,22 @@ class ActivityInstance:
         state the activity instance in the event history (if it has failed,
         been executed, or marked as completed.)
 
+        The id is calculated once per instance.
+
         Return:
             str: composed of the activity name (task list), and the activity
                 id.
         """
 
-        if not self.local_context:
-            activity_id = 1
-        else:
-            activity_id = utils.create_dictionary_key(self.local_context)
-
-        return '{name}-{id}'.format(
-            name=self.activity_name,
-            id=activity_id)
+        if self._id is None:
+            if not self.local_context:
+                key = 1
+            elif getattr(self.activity_worker, 'canonical_ids', None) is True:
+                key = utils.create_canonical_key(self.local_context)
+            else:
+                key = utils.create_dictionary_key(self.local_context)
+            self._id = create_instance_id(self.activity_name, key)
+        return self._id
 
     @property
     def schedule_to_start(self):
@@ -147,7 +210,7 @@ class ActivityInstance:
         """
 
         return (
-            self.activity_worker.pool_size *
+            (self.pool_size or self.activity_worker.pool_size) *
             self.activity_worker.schedule_to_start_timeout)
 
     @property
@@ -177,7 +240,7 @@ class ActivityInstance:
             int: Task list timeout.
         """
 
-        return self.runner.timeout(self.global_context)
+        return self.description.get('timeout')
 
     @property
     def heartbeat_timeout(self):
@@ -191,7 +254,23 @@ class ActivityInstance:
             int: Task list timeout.
         """
 
-        return self.runner.heartbeat(self.global_context)
+        return self.description.get('heartbeat')
+
+    @property
+    def description(self):
+        """Return the description of the runner for this instance.
+
+        The runner flattens the tasks (and runs the task lists) to calculate
+        the timeouts and the requirements: this is done once per instance.
+
+        Return:
+            dict: the timeout, heartbeat and requirements of the runner (see
+                `BaseRunner.describe`.)
+        """
+
+        if self._description is None:
+            self._description = self.runner.describe(self.global_context)
+        return self._description
 
     @property
     def runner(self):
@@ -223,22 +302,21 @@ class ActivityInstance:
         """
 
         activity_input = dict()
-
-        try:
-            for requirement in self.runner.requirements(self.global_context):
-                value = self.global_context.get(requirement)
-                if value is not None:
-                    activity_input.update({requirement: value})
-
-            activity_input.update({
-                'execution.domain': self.global_context.get('execution.domain'),
-                'execution.run_id': self.global_context.get('execution.run_id'),
-                'execution.workflow_id': self.global_context.get(
-                    'execution.workflow_id')
-            })
-
-        except runner.NoRunnerRequirementsFound:
-            return self.global_context
+        requirements = self.description.get('requirements')
+        if requirements is None:
+            return dict(self.global_context)
+
+        for requirement in requirements:
+            value = self.global_context.get(requirement)
+            if value is not None:
+                activity_input.update({requirement: value})
+
+        activity_input.update({
+            'execution.domain': self.global_context.get('execution.domain'),
+            'execution.run_id': self.global_context.get('execution.run_id'),
+            'execution.workflow_id': self.global_context.get(
+                'execution.workflow_id')
+        })
 
         return activity_input
 
@@ -258,6 +336,15 @@ class Activity(log.GarconLogger):
         self.name = None
         self.domain = None
         self.task_list = None
+        self.canonical_ids = False
+        self.max_in_flight = None
+        self.batch_size = None
+        self.batch_duration = None
+        self.order = None
+        self.priority = None
+        self.pollers = None
+        self.concurrency = None
+        self.prefetch = None
 
     @backoff.on_exception(
         backoff.expo,
@@ -307,6 +394,22 @@ class Activity(log.GarconLogger):
                 is recorded in the ActivityTaskStarted event in the AWS
                 console. This enables diagnostic tracing when problems arise.
         """
+
+        execution = self.poll(identity)
+        if execution:
+            self.process(execution)
+        return True
+
+    def poll(self, identity=None):
+        """Poll for an activity task.
+
+        Args:
+            identity (str): Identity of the worker making the request.
+        Return:
+            ActivityExecution: the activity execution (None if the poll has
+                failed or has not returned any task.)
+        """
+
         try:
             if identity:
                 self.logger.debug('Polling with {}'.format(identity))
@@ -322,7 +425,18 @@ class Activity(log.GarconLogger):
             if self.on_exception:
                 self.on_exception(self, error)
             self.logger.error(error, exc_info=True)
-            return True
+            return None
+
+        if execution.activity_id:
+            return execution
+        return None
+
+    def process(self, execution):
+        """Execute an activity task and respond to SWF.
+
+        Args:
+            execution (ActivityExecution): the activity execution.
+        """
 
         self.set_log_context(execution.context)
         if execution.activity_id:
@@ -342,7 +456,6 @@ class Activity(log.GarconLogger):
                         self.on_exception(self, error2)
 
         self.unset_log_context()
-        return True
 
     def execute_activity(self, activity):
         """Execute the runner.
@@ -354,8 +467,38 @@ class Activity(log.GarconLogger):
             dict: The result of the operation.
         """
 
+        if BATCH_KEY in activity.context:
+            return self.execute_batch(activity)
         return self.runner.execute(activity, activity.context)
 
+    def execute_batch(self, activity):
+        """Execute the runner on each instance of a batch.
+
+        The input of a batch holds the shared context, and the id and the
+        local context of each instance (see `decider.schedule_batch`.)
+
+        Args:
+            activity (ActivityExecution): the activity execution.
+
+        Return:
+            dict: The results of the instances (by instance id), and the
+                duration of the batch.
+        """
+
+        shared_context = {
+            key: value for key, value in activity.context.items()
+            if key != BATCH_KEY}
+        results = dict()
+
+        start = time.monotonic()
+        for instance_id, local_context in activity.context[BATCH_KEY]:
+            results[instance_id] = self.runner.execute(
+                activity, collections.ChainMap(local_context, shared_context))
+
+        return {
+            BATCH_KEY: results,
+            BATCH_DURATION_KEY: time.monotonic() - start}
+
     def hydrate(self, data):
         """Hydrate the task with information provided.
 
@@ -389,6 +532,46 @@ class Activity(log.GarconLogger):
         self.generators = getattr(
             self, 'generators', None) or data.get('generators')
 
+        # Canonical ids are stable for nested values and faster to compute,
+        # but differ from the default ids (changing this option on an
+        # activity of a running workflow reschedules its instances.)
+        self.canonical_ids = (
+            self.canonical_ids or bool(data.get('canonical_ids')))
+
+        # At most `max_in_flight` instances of the activity are scheduled and
+        # not closed at any time (see `find_available_activities`.)
+        self.max_in_flight = (
+            self.max_in_flight or data.get('max_in_flight'))
+
+        # Instances can be packed in batches of up to `batch_size` instances
+        # (run in one activity task.) When `batch_duration` is set, the size
+        # of the batches adapts to the observed duration of the instances
+        # (see `get_batch_size`.)
+        self.batch_size = self.batch_size or data.get('batch_size')
+        self.batch_duration = (
+            self.batch_duration or data.get('batch_duration'))
+
+        # Order of the instances (fifo, lpt or a custom key), and default
+        # priority of the instances (see `instances`.)
+        self.order = self.order or data.get('order')
+        if self.order not in (None, ORDER_FIFO, ORDER_LPT) and (
+                not callable(self.order)):
+            raise ValueError(
+                'The order of an activity should be fifo, lpt or a key.')
+
+        if self.priority is None:
+            self.priority = data.get('priority')
+
+        # Number of threads polling the task list of the activity, and
+        # maximum number of tasks executed at the same time (defaults to the
+        # number of pollers, see `concurrent_worker_runner`.)
+        self.pollers = self.pollers or data.get('pollers')
+        self.concurrency = self.concurrency or data.get('concurrency')
+
+        # Number of tasks polled ahead, while the other tasks run (they are
+        # heartbeated while they wait.)
+        self.prefetch = self.prefetch or data.get('prefetch')
+
     def instances(self, context):
         """Get all instances for one activity based on the current context.
 
@@ -400,6 +583,20 @@ class Activity(log.GarconLogger):
         instances of the activity are needed – and it will generate them
         (regardless of their state.)
 
+        Generators can also return their values in columns: a dict of lists
+        (or arrays) of equal length, with one row per value (see `Columns`.)
+
+        The combinations of the generator values are streamed: the pool size
+        is calculated from the lengths of the values (or their length hints,
+        see `length_hint`) and the instances are created as they are consumed.
+
+        The contexts yielded by the generators can carry scheduling hints: a
+        cost (`garcon.cost`) and a priority (`garcon.priority`, which becomes
+        the SWF task priority.) The instances are ordered by the order of the
+        activity: the order of the generators (fifo), the largest cost first
+        (lpt), or a custom key (a callable that receives the instance.)
+        Ordering the instances requires to create all of them first.
+
         Args:
             context (dict): the current context.
         Return:
@@ -409,26 +606,101 @@ class Activity(log.GarconLogger):
 
         if not self.generators:
             self.pool_size = 1
-            yield ActivityInstance(self, execution_context=context)
+            yield ActivityInstance(
+                self, execution_context=context, pool_size=1,
+                priority=self.priority)
             return
 
         generator_values = []
         for generator in self.generators:
-            generator_values.append(generator(context))
-
-        contexts = list(itertools.product(*generator_values))
-        self.pool_size = len(contexts)
-        for generator_contexts in contexts:
-            # Each generator returns a context, merge all the contexts
-            # to only be one - which can be used to 1/ create the id of the
-            # activity and 2/ be passed as a local context.
-            instance_context = dict()
-            for current_generator_context in generator_contexts:
-                instance_context.update(current_generator_context.items())
+            values = generator(context)
+            if isinstance(values, abc.Mapping):
+                values = Columns(values)
+            generator_values.append(
+                (values, getattr(generator, 'length_hint', None)))
 
-            yield ActivityInstance(
-                self, execution_context=context,
-                local_context=instance_context)
+        size, contexts = stream_product(generator_values, context)
+
+        # Instances wait in the task list along with the other instances in
+        # flight only.
+        self.pool_size = size
+        if self.max_in_flight:
+            self.pool_size = min(self.pool_size, self.max_in_flight)
+
+        instances = self.create_instances(context, contexts)
+        if self.order == ORDER_LPT:
+            instances = sorted(
+                instances, key=lambda instance: instance.cost or 0,
+                reverse=True)
+        elif callable(self.order):
+            instances = sorted(instances, key=self.order)
+
+        yield from instances
+
+    def create_instances(self, context, contexts):
+        """Create the instances of the activity from the generator contexts.
+
+        The instances are created in chunks (the canonical ids of a chunk are
+        calculated in one pass.)
+
+        Args:
+            context (dict): the current context.
+            contexts (iterable): the contexts of the generators (one tuple
+                per instance.)
+        Yield:
+            ActivityInstance: the instances of the activity.
+        """
+
+        contexts = iter(contexts)
+        while True:
+            chunk = list(itertools.islice(contexts, INSTANCES_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            # Each generator returns a context, merge all the contexts to only
+            # be one - which can be used to 1/ create the id of the activity
+            # and 2/ be passed as a local context.
+            # The rows of a columnar generator are used as they are when they
+            # are not merged.
+            instance_contexts = []
+            hints = []
+            for generator_contexts in chunk:
+                if len(generator_contexts) == 1 and isinstance(
+                        generator_contexts[0], ColumnRow):
+                    instance_context = generator_contexts[0]
+                    cost, priority = instance_context.hints
+                    hints.append((
+                        cost, self.priority if priority is None else priority))
+                    instance_contexts.append(instance_context)
+                    continue
+
+                instance_context = dict()
+                for current_generator_context in generator_contexts:
+                    instance_context.update(current_generator_context.items())
+                    if isinstance(current_generator_context, ColumnRow):
+                        instance_context.update(
+                            current_generator_context.hint_items())
+                hints.append((
+                    instance_context.pop(COST_KEY, None),
+                    instance_context.pop(PRIORITY_KEY, self.priority)))
+                instance_contexts.append(instance_context)
+
+            activity_ids = [None] * len(instance_contexts)
+            if self.canonical_ids:
+                keys = iter(utils.create_canonical_keys(
+                    instance_context for instance_context in instance_contexts
+                    if instance_context))
+                activity_ids = [
+                    create_instance_id(
+                        self.name, next(keys) if instance_context else 1)
+                    for instance_context in instance_contexts]
+
+            for instance_context, activity_id, (cost, priority) in zip(
+                    instance_contexts, activity_ids, hints):
+                yield ActivityInstance(
+                    self, execution_context=context,
+                    local_context=instance_context, pool_size=self.pool_size,
+                    activity_id=activity_id, cost=cost, priority=priority)
 
 
 class ExternalActivity(Activity):
@@ -514,7 +786,9 @@ class ActivityExecution(log.GarconLogger):
 
 class ActivityWorker():
 
-    def __init__(self, flow, activities=None):
+    def __init__(
+            self, flow, activities=None, pollers=None, concurrency=None,
+            capacity=None, prefetch=None):
         """Initiate an activity worker.
 
         The activity worker take in consideration all the activities from a
@@ -528,11 +802,26 @@ class ActivityWorker():
             flow (module): the flow module.
             activities (list): the list of activities that this worker should
                 handle.
+            pollers (int): the number of pollers of each activity (overrides
+                the `pollers` option of the activities.)
+            concurrency (int): the maximum number of tasks of each activity
+                executed at the same time (overrides the `concurrency` option
+                of the activities.)
+            capacity (dict): the resources of the host, for instance:
+                `{'cpu': 8, 'memory_mb': 16384}`. The activities only poll
+                for a task when the resources their tasks need (see
+                `task.decorate`) are available.
+            prefetch (int): the number of tasks of each activity polled ahead
+                (overrides the `prefetch` option of the activities.)
         """
 
         self.flow = flow
         self.activities = find_workflow_activities(self.flow)
         self.worker_activities = activities
+        self.pollers = pollers
+        self.concurrency = concurrency
+        self.capacity = Capacity(capacity) if capacity else None
+        self.prefetch = prefetch
 
     def run(self):
         """Run the activities.
@@ -542,9 +831,20 @@ class ActivityWorker():
             if (self.worker_activities and
                     activity.name not in self.worker_activities):
                 continue
-            thread = threading.Thread(
-                target=worker_runner,
-                args=(activity,))
+
+            pollers = self.pollers or activity.pollers or 1
+            concurrency = self.concurrency or activity.concurrency or pollers
+            prefetch = self.prefetch or activity.prefetch or 0
+            if isinstance(activity, ExternalActivity) or (
+                    pollers == 1 and concurrency == 1 and not prefetch and
+                    not self.capacity):
+                target, args = worker_runner, (activity,)
+            else:
+                target = concurrent_worker_runner
+                args = (
+                    activity, pollers, concurrency, self.capacity, prefetch)
+
+            thread = threading.Thread(target=target, args=args)
             thread.start()
             threads.append(thread)
 
@@ -552,6 +852,180 @@ class ActivityWorker():
             thread.join()
 
 
+class Capacity:
+    """
+    Capacity
+    ========
+
+    Resources of a host shared by the activities of a worker. The resources
+    an activity task needs are reserved before polling for the task, and
+    released once the task has been executed.
+    """
+
+    def __init__(self, resources):
+        """Create the capacity.
+
+        Args:
+            resources (dict): the amount of each resource.
+        """
+
+        self.resources = dict(resources)
+        self.used = {name: 0 for name in self.resources}
+        self.condition = threading.Condition()
+
+    def fits(self, needs):
+        """Check if the needs fit in the free capacity.
+
+        Resources that are not part of the capacity are not limited. A need
+        larger than the capacity fits when the resource is not used (so the
+        task runs on its own.)
+
+        Args:
+            needs (dict): the amount of each resource needed.
+        Return:
+            bool: if the needs fit.
+        """
+
+        for name, amount in needs.items():
+            if name not in self.resources or not self.used[name]:
+                continue
+            if self.used[name] + amount > self.resources[name]:
+                return False
+        return True
+
+    def acquire(self, needs):
+        """Reserve resources (waits until they are free.)
+
+        Args:
+            needs (dict): the amount of each resource needed.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(needs))
+            for name, amount in needs.items():
+                if name in self.used:
+                    self.used[name] += amount
+
+    def release(self, needs):
+        """Release resources.
+
+        Args:
+            needs (dict): the amount of each resource to release.
+        """
+
+        with self.condition:
+            for name, amount in needs.items():
+                if name in self.used:
+                    self.used[name] -= amount
+            self.condition.notify_all()
+
+
+class Columns:
+    """
+    Columns
+    =======
+
+    Columnar values of a generator: a dict of lists (or NumPy arrays) of equal
+    length. The values are not copied: each row is a read only view on the
+    columns (see `ColumnRow`.) The scheduling hints (`garcon.cost` and
+    `garcon.priority`) can be given as columns too.
+    """
+
+    def __init__(self, columns):
+        """Create the columns.
+
+        Args:
+            columns (dict): the columns (by context key.)
+        """
+
+        self.hints = dict()
+        self.columns = dict()
+        for key, column in columns.items():
+            if key in (COST_KEY, PRIORITY_KEY):
+                self.hints[key] = column
+            else:
+                self.columns[key] = column
+
+        lengths = set(len(column) for column in columns.values())
+        if len(lengths) > 1:
+            raise ValueError('The columns should have the same length.')
+        self.length = lengths.pop() if lengths else 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield ColumnRow(self, index)
+
+
+class ColumnRow(abc.Mapping):
+    """
+    Column Row
+    ==========
+
+    Read only view on one row of the columns of a generator. NumPy values are
+    converted to python values when they are read.
+    """
+
+    __slots__ = ('columns', 'index')
+
+    def __init__(self, columns, index):
+        """Create the row view.
+
+        Args:
+            columns (Columns): the columns.
+            index (int): the index of the row.
+        """
+
+        self.columns = columns
+        self.index = index
+
+    def __getitem__(self, key):
+        return to_python(self.columns.columns[key][self.index])
+
+    def __iter__(self):
+        return iter(self.columns.columns)
+
+    def __len__(self):
+        return len(self.columns.columns)
+
+    def hint_items(self):
+        """Get the scheduling hints of the row.
+
+        Return:
+            dict: the scheduling hints of the row (by context key.)
+        """
+
+        return {
+            key: to_python(column[self.index])
+            for key, column in self.columns.hints.items()}
+
+    @property
+    def hints(self):
+        """Return the cost and the priority of the row.
+        """
+
+        hints = self.hint_items()
+        return hints.get(COST_KEY), hints.get(PRIORITY_KEY)
+
+
+def to_python(value):
+    """Convert a NumPy value into a python value.
+
+    Args:
+        value (object): the value.
+    Return:
+        object: the python value (the value itself if it is not a NumPy
+            value.)
+    """
+
+    tolist = getattr(value, 'tolist', None)
+    if tolist is None:
+        return value
+    return tolist()
+
+
 class ActivityState:
     """
     Activity State
@@ -573,6 +1047,7 @@ class ActivityState:
         self.activity_id = activity_id
         self._result = None
         self.states = []
+        self.duration = None
 
     @property
     def result(self):
@@ -632,6 +1107,288 @@ class ActivityState:
             raise ActivityInstanceNotReadyException()
 
 
+class CompiledFlow:
+    """
+    Compiled Flow
+    =============
+
+    A compiled flow is built once from a flow module: it holds the list of
+    activities of the flow and their requirement graph, validated and ordered
+    in topological layers (the activities of a layer only require activities
+    of the previous layers.) It avoids inspecting the flow module on every
+    decision and allows to only look at the activities whose requirements
+    have completed.
+    """
+
+    def __init__(self, flow):
+        """Compile a flow.
+
+        Args:
+            flow (module): the flow module.
+
+        Raises:
+            CyclicRequirementsException: if the requirements of the activities
+                have a cycle.
+        """
+
+        self.flow = flow
+        self.activities = find_workflow_activities(flow)
+        self.layers = []
+
+        names = set(current.name for current in self.activities)
+        placed = set()
+        remaining = self.activities
+        while remaining:
+            layer = [
+                current for current in remaining
+                if all(
+                    requirement.name in placed or
+                    requirement.name not in names
+                    for requirement in current.requires or [])]
+
+            if not layer:
+                raise CyclicRequirementsException(
+                    'The requirements of the activities {} have a cycle.'
+                    .format(', '.join(
+                        current.name for current in remaining)))
+
+            self.layers.append(layer)
+            placed.update(current.name for current in layer)
+            remaining = [
+                current for current in remaining
+                if current.name not in placed]
+
+    def frontier(self, history):
+        """Get the activities that have all their requirements completed.
+
+        Args:
+            history (dict): the history information.
+        Yield:
+            Activity: the activities (in topological order.)
+        """
+
+        completed = dict()
+        for layer in self.layers:
+            for current_activity in layer:
+                if all(
+                        is_activity_completed(
+                            requirement, history, completed)
+                        for requirement in current_activity.requires or []):
+                    yield current_activity
+
+
+def compile_flow(flow):
+    """Compile a flow (if it is not already compiled.)
+
+    Args:
+        flow (module): the flow module (or its compiled flow.)
+    Return:
+        CompiledFlow: the compiled flow.
+    """
+
+    if isinstance(flow, CompiledFlow):
+        return flow
+    return CompiledFlow(flow)
+
+
+def is_activity_completed(current_activity, history, completed=None):
+    """Check if all the scheduled instances of an activity have completed.
+
+    Args:
+        current_activity (Activity): the activity.
+        history (dict): the history information.
+        completed (dict): optional memo of the activities already checked.
+    Return:
+        boolean: if the activity has been scheduled and all its instances
+            have completed.
+    """
+
+    if completed is not None and current_activity.name in completed:
+        return completed[current_activity.name]
+
+    activity_history = history.get(current_activity.name)
+    is_completed = bool(activity_history) and all(
+        ACTIVITY_COMPLETED in states.states
+        for states in activity_history.values())
+
+    if completed is not None:
+        completed[current_activity.name] = is_completed
+    return is_completed
+
+
+class InstanceCache:
+    """
+    Instance Cache
+    ==============
+
+    Within one decision, the instances of an activity are needed more than
+    once (to find the available activities, then the uncomplete ones.) The
+    instance cache memoizes them so the generators only run once per activity
+    for a given context fingerprint.
+    """
+
+    def __init__(self, fingerprint):
+        """Create an instance cache.
+
+        Args:
+            fingerprint (tuple): the fingerprint of the context the instances
+                are created from (see `ExecutionContext.fingerprint`.)
+        """
+
+        self.fingerprint = fingerprint
+        self.instances = dict()
+
+    def get(self, current_activity, context):
+        """Get the instances of an activity.
+
+        Args:
+            current_activity (Activity): the activity.
+            context (dict): the context (matching the fingerprint.)
+        Return:
+            CachedInstances: the instances of the activity.
+        """
+
+        key = (current_activity.name, self.fingerprint)
+        instances = self.instances.get(key)
+        if instances is None:
+            instances = CachedInstances(current_activity.instances(context))
+            self.instances[key] = instances
+        return instances
+
+
+class CachedInstances:
+    """
+    Cached Instances
+    ================
+
+    The instances of an activity are created lazily: they are only created
+    when they are consumed, and kept for the next iterations (so a consumer
+    that stops early, like a window or a budget, does not create all of
+    them.)
+    """
+
+    def __init__(self, instances):
+        """Create the cached instances.
+
+        Args:
+            instances (iterable): the instances of the activity.
+        """
+
+        self.created = []
+        self.pending = iter(instances)
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index < len(self.created):
+                yield self.created[index]
+            elif self.pending is None:
+                return
+            else:
+                try:
+                    instance = next(self.pending)
+                except StopIteration:
+                    self.pending = None
+                    return
+                self.created.append(instance)
+                yield instance
+            index += 1
+
+
+def length_hint(hint):
+    """Declare the length of the values of a generator.
+
+    The values of a generator are streamed: when they don't have a length
+    (for instance when the generator yields them), the length hint is used to
+    calculate the pool size of the activity without consuming them.
+
+    Example::
+
+        @activity.length_hint(lambda context: len(context['ids']))
+        def generator(context):
+            for id in context['ids']:
+                yield {'id': id}
+
+    Args:
+        hint (int|callable): the length of the values, or a callable that
+            receives the context and returns the length.
+    Return:
+        callable: the decorator.
+    """
+
+    def decorator(generator):
+        generator.length_hint = hint
+        return generator
+    return decorator
+
+
+def stream_product(values, context):
+    """Stream the cartesian product of the values of the generators.
+
+    Only the values of the first generator are streamed: the values of the
+    other generators are iterated once per value of the first generator, and
+    are kept in memory. The size of the product is calculated from the
+    lengths of the values.
+
+    Args:
+        values (list): the values of each generator, with their length hint
+            (see `length_hint`.)
+        context (dict): the current context (passed to the length hints.)
+    Return:
+        tuple: the size of the product and the product (an iterator of the
+            tuples of contexts, in the order of `itertools.product`.)
+    """
+
+    (first, hint), others = values[0], values[1:]
+    pools = [tuple(other) for other, other_hint in others]
+
+    if callable(hint):
+        hint = hint(context)
+    if not isinstance(hint, int):
+        hint = operator.length_hint(first, -1)
+    if hint < 0:
+        first = tuple(first)
+        hint = len(first)
+
+    size = functools.reduce(operator.mul, (len(pool) for pool in pools), hint)
+
+    def product():
+        for value in first:
+            for rest in itertools.product(*pools):
+                yield (value,) + rest
+
+    return size, product()
+
+
+def get_instances(current_activity, context, instance_cache=None):
+    """Get the instances of an activity.
+
+    Args:
+        current_activity (Activity): the activity.
+        context (dict): the current context.
+        instance_cache (InstanceCache): optional instance cache.
+    Return:
+        iterable: the instances of the activity.
+    """
+
+    if instance_cache is None:
+        return current_activity.instances(context)
+    return instance_cache.get(current_activity, context)
+
+
+def create_instance_id(activity_name, key):
+    """Create the id of an activity instance.
+
+    Args:
+        activity_name (str): the name of the activity.
+        key (str): the key of the instance local context.
+    Return:
+        str: the id of the instance.
+    """
+
+    return '{name}-{id}'.format(name=activity_name, id=key)
+
+
 def worker_runner(worker):
     """Run indefinitely the worker.
 
@@ -643,6 +1400,142 @@ def worker_runner(worker):
         continue
 
 
+def concurrent_worker_runner(
+        worker, pollers, concurrency, capacity=None, prefetch=0, stop=None):
+    """Run indefinitely the worker with concurrent pollers and executions.
+
+    The pollers only poll when an execution slot (or a prefetch slot) is free
+    and the resources the tasks need are available, and the tasks are
+    executed in a thread pool of `concurrency` threads. Up to `prefetch`
+    tasks are polled ahead: they wait for an execution slot, and are
+    heartbeated while they wait (see `PrefetchedTasks`.)
+
+    Args:
+        worker (object): the Activity worker.
+        pollers (int): the number of pollers.
+        concurrency (int): the maximum number of tasks executed at the same
+            time.
+        capacity (Capacity): optional capacity shared by the activities.
+        prefetch (int): the number of tasks polled ahead.
+        stop (threading.Event): optional event that stops the pollers.
+    """
+
+    stop = stop or threading.Event()
+    slots = threading.BoundedSemaphore(concurrency + prefetch)
+    needs = worker.runner.resources() if capacity else {}
+    prefetched = PrefetchedTasks(worker) if prefetch else None
+    process = worker.process
+
+    if prefetched:
+        heartbeats = threading.Thread(target=prefetched.run, args=(stop,))
+        heartbeats.start()
+
+        def process(execution):
+            prefetched.remove(execution)
+            worker.process(execution)
+
+    def release(future=None):
+        if capacity:
+            capacity.release(needs)
+        slots.release()
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def poll():
+            while not stop.is_set():
+                slots.acquire()
+                if capacity:
+                    capacity.acquire(needs)
+                execution = worker.poll()
+                if not execution:
+                    release()
+                    continue
+                if prefetched:
+                    prefetched.add(execution)
+                executor.submit(process, execution).add_done_callback(release)
+
+        threads = [
+            threading.Thread(target=poll) for poller in range(pollers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if prefetched:
+        heartbeats.join()
+
+
+class PrefetchedTasks:
+    """
+    Prefetched Tasks
+    ================
+
+    Tasks polled ahead wait for an execution slot. They are heartbeated while
+    they wait, every half of their heartbeat timeout, so SWF does not time
+    them out.
+    """
+
+    def __init__(self, worker):
+        """Create the prefetched tasks.
+
+        Args:
+            worker (Activity): the activity of the tasks.
+        """
+
+        self.worker = worker
+        self.waiting = dict()
+        self.lock = threading.Lock()
+
+    def add(self, execution):
+        """Add a task that waits for an execution slot.
+
+        Args:
+            execution (ActivityExecution): the activity execution.
+        """
+
+        interval = self.worker.runner.heartbeat(execution.context) / 2
+        with self.lock:
+            self.waiting[id(execution)] = [
+                execution, interval, time.monotonic() + interval]
+
+    def remove(self, execution):
+        """Remove a task (it is about to be executed.)
+
+        Args:
+            execution (ActivityExecution): the activity execution.
+        """
+
+        with self.lock:
+            self.waiting.pop(id(execution), None)
+
+    def heartbeat(self):
+        """Heartbeat the waiting tasks that need it.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            due = [
+                waiting for waiting in self.waiting.values()
+                if waiting[2] <= now]
+            for waiting in due:
+                waiting[2] = now + waiting[1]
+
+        for execution, interval, deadline in due:
+            try:
+                execution.heartbeat()
+            except Exception as error:
+                self.worker.logger.error(error, exc_info=True)
+
+    def run(self, stop):
+        """Heartbeat the waiting tasks until the worker stops.
+
+        Args:
+            stop (threading.Event): the event that stops the worker.
+        """
+
+        while not stop.wait(PREFETCH_HEARTBEAT_CHECK):
+            self.heartbeat()
+
+
 def create(client, domain, workflow_name, version='1.0', on_exception=None):
     """Helper method to create Activities.
 
@@ -688,56 +1581,70 @@ def create(client, domain, workflow_name, version='1.0', on_exception=None):
             tasks=options.get('tasks'),
             run=options.get('run'),
             schedule_to_start=options.get('schedule_to_start'),
+            canonical_ids=options.get('canonical_ids'),
+            max_in_flight=options.get('max_in_flight'),
+            batch_size=options.get('batch_size'),
+            batch_duration=options.get('batch_duration'),
+            order=options.get('order'),
+            priority=options.get('priority'),
+            pollers=options.get('pollers'),
+            concurrency=options.get('concurrency'),
+            prefetch=options.get('prefetch'),
             on_exception=options.get('on_exception') or on_exception))
         return activity
 
     return wrapper
 
 
-def find_available_activities(flow, history, context):
+def find_available_activities(flow, history, context, instance_cache=None):
     """Find all available activity instances of a flow.
 
     The history contains all the information of our activities (their state).
-    This method focuses on finding all the activities that need to run.
+    This method focuses on finding all the activities that need to run: only
+    the activities of the frontier (the ones whose requirements have all
+    completed) are considered. The instances of an activity that defines
+    `max_in_flight` are only available while the window of instances in
+    flight is not full.
 
     Args:
-        flow (module): the flow module.
+        flow (module): the flow module (or its compiled flow.)
         history (dict): the history information.
         context (dict): from the context find the available activities.
+        instance_cache (InstanceCache): optional instance cache.
     """
 
-    for instance in find_activities(flow, context):
-        # If an event is already available for the activity, it means it is
-        # not in standby anymore, it's either processing or has been completed.
-        # The activity is thus not available anymore.
-        states = history.get(instance.activity_name, {}).get(instance.id)
-
-        if states:
-            if states.get_last_state() != ACTIVITY_FAILED:
+    for current_activity in compile_flow(flow).frontier(history):
+        window = None
+        if current_activity.max_in_flight:
+            window = current_activity.max_in_flight - count_in_flight(
+                history.get(current_activity.name, {}))
+            if window <= 0:
                 continue
-            elif (not instance.retry or
-                  instance.retry < count_activity_failures(states)):
-                raise Exception(
-                    'The activity failures has exceeded its retry limit.')
-
-        can_yield = True
-        for requirement in instance.activity_worker.requires:
-            require_history = history.get(requirement.name)
-
-            if not require_history:
-                can_yield = False
-                break
-
-            for requirement_states in require_history.values():
-                if ACTIVITY_COMPLETED not in requirement_states.states:
-                    can_yield = False
-                    break
 
-        if can_yield:
+        for instance in get_instances(
+                current_activity, context, instance_cache):
+            # If an event is already available for the activity, it means it
+            # is not in standby anymore, it's either processing or has been
+            # completed. The activity is thus not available anymore.
+            states = history.get(instance.activity_name, {}).get(instance.id)
+
+            if states:
+                if states.get_last_state() != ACTIVITY_FAILED:
+                    continue
+                elif (not instance.retry or
+                      instance.retry < count_activity_failures(states)):
+                    raise Exception(
+                        'The activity failures has exceeded its retry limit.')
+
             yield instance
 
+            if window is not None:
+                window -= 1
+                if not window:
+                    break
 
-def find_uncomplete_activities(flow, history, context):
+
+def find_uncomplete_activities(flow, history, context, instance_cache=None):
     """Find uncomplete activity instances.
 
     Uncomplete activities are all the activities that are not marked as
@@ -747,25 +1654,31 @@ def find_uncomplete_activities(flow, history, context):
         flow (module): the flow module.
         history (dict): the history information.
         context (dict): from the context find the available activities.
+        instance_cache (InstanceCache): optional instance cache.
     Yield:
         activity: The available activity.
     """
 
-    for instance in find_activities(flow, context):
-        states = history.get(instance.activity_name, {}).get(instance.id)
-        if not states or ACTIVITY_COMPLETED not in states.states:
-            yield instance
+    for current_activity in find_workflow_activities(flow):
+        for instance in get_instances(
+                current_activity, context, instance_cache):
+            states = history.get(instance.activity_name, {}).get(instance.id)
+            if not states or ACTIVITY_COMPLETED not in states.states:
+                yield instance
 
 
 def find_workflow_activities(flow):
     """Retrieves all the activities from a flow
 
     Args:
-        flow (module): the flow module.
+        flow (module): the flow module (or its compiled flow.)
     Return:
         list: all the activities.
     """
 
+    if isinstance(flow, CompiledFlow):
+        return flow.activities
+
     activities = []
     for module_attribute in dir(flow):
         current_activity = getattr(flow, module_attribute)
@@ -774,26 +1687,69 @@ def find_workflow_activities(flow):
     return activities
 
 
-def find_activities(flow, context):
+def find_activities(flow, context, instance_cache=None):
     """Retrieves all the activities from a flow.
 
     Args:
-        flow (module): the flow module.
+        flow (module): the flow module (or its compiled flow.)
+        context (dict): the current context.
+        instance_cache (InstanceCache): optional instance cache.
     Return:
         list: All the activity instances for the flow.
     """
 
     activities = []
-    for module_attribute in dir(flow):
-        current_activity = getattr(flow, module_attribute)
-
-        if isinstance(current_activity, Activity):
-            for activity_instance in current_activity.instances(context):
-                activities.append(activity_instance)
+    for current_activity in find_workflow_activities(flow):
+        for activity_instance in get_instances(
+                current_activity, context, instance_cache):
+            activities.append(activity_instance)
 
     return activities
 
 
+def count_in_flight(activity_states):
+    """Count the instances of an activity that are in flight.
+
+    Args:
+        activity_states (dict): the states of the instances of the activity.
+    Return:
+        int: the number of instances scheduled and not closed yet.
+    """
+
+    return sum(
+        1 for states in activity_states.values()
+        if states.get_last_state() == ACTIVITY_SCHEDULED)
+
+
+def get_batch_size(current_activity, activity_states):
+    """Get the size of the next batches of an activity.
+
+    Without target duration, the batches have the maximum size. Otherwise,
+    the size is the number of instances that fit in the target duration,
+    based on the average duration of the instances that have completed.
+
+    Args:
+        current_activity (Activity): the activity.
+        activity_states (dict): the states of the instances of the activity.
+    Return:
+        int: the size of the batches.
+    """
+
+    batch_size = current_activity.batch_size or 1
+    target_duration = current_activity.batch_duration
+    if batch_size == 1 or not target_duration:
+        return batch_size
+
+    durations = [
+        states.duration for states in activity_states.values()
+        if states.duration is not None]
+    average_duration = durations and sum(durations) / len(durations)
+    if not average_duration:
+        return batch_size
+
+    return max(1, min(batch_size, int(target_duration / average_duration)))
+
+
 def count_activity_failures(states):
     """Count the number of times an activity has failed.
 
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio
+=======
+
+Coroutine versions of the activity and decider loops. A long poll does not
+block a thread: one event loop can hold many concurrent polls (for instance
+for all the activities of a worker) while the tasks and the decisions, which
+are blocking, are offloaded to a thread pool.
+
+The loops work with any async client exposing the SWF methods as coroutines
+(see `AsyncClient`.) `ThreadedClient` wraps a regular boto3 client, and
+`MemoryClient` is an in-memory stand-in (useful for tests.)
+
+Run the activities of a flow::
+
+    import asyncio
+    from garcon import aio
+
+    client = aio.ThreadedClient(flow.client)
+    asyncio.run(aio.serve_activities(flow, client, pollers=10))
+"""
+
+import asyncio
+import collections
+import copy
+import functools
+import json
+import time
+
+from garcon import activity
+
+
+DEFAULT_POLL_TIMEOUT = 60  # seconds, matches SWF long polls.
+
+
+class AsyncClient:
+    """Async client protocol.
+
+    The coroutines take the same arguments as the boto3 SWF client methods
+    and return the same responses.
+    """
+
+    async def poll_for_activity_task(self, **kwargs):
+        raise NotImplementedError()
+
+    async def respond_activity_task_completed(self, **kwargs):
+        raise NotImplementedError()
+
+    async def respond_activity_task_failed(self, **kwargs):
+        raise NotImplementedError()
+
+    async def record_activity_task_heartbeat(self, **kwargs):
+        raise NotImplementedError()
+
+    async def poll_for_decision_task(self, **kwargs):
+        raise NotImplementedError()
+
+    async def respond_decision_task_completed(self, **kwargs):
+        raise NotImplementedError()
+
+
+class ThreadedClient:
+
+    def __init__(self, client, executor=None):
+        """Create an async client from a boto3 client.
+
+        The calls are made in a thread pool.
+
+        Args:
+            client (boto3.client): the boto3 swf client.
+            executor (concurrent.futures.Executor): the executor used to make
+                the calls (defaults to the executor of the event loop.)
+        """
+
+        self.client = client
+        self.executor = executor
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    async def call(self, name, **kwargs):
+        """Call a method of the boto3 client.
+
+        Args:
+            name (str): the name of the method.
+        Return:
+            dict: the response.
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(getattr(self.client, name), **kwargs))
+
+
+class MemoryClient(AsyncClient):
+
+    def __init__(self, poll_timeout=DEFAULT_POLL_TIMEOUT, poll_interval=0.01):
+        """Create an in-memory client.
+
+        Activity and decision tasks are added to in-memory task lists and the
+        responses are recorded.
+
+        Args:
+            poll_timeout (int): how long a poll waits for a task (an empty
+                response is returned after that time.)
+            poll_interval (float): how often a waiting poll checks the task
+                list.
+        """
+
+        self.poll_timeout = poll_timeout
+        self.poll_interval = poll_interval
+        self.activity_tasks = collections.defaultdict(collections.deque)
+        self.decision_tasks = collections.defaultdict(collections.deque)
+        self.completed = []
+        self.failed = []
+        self.heartbeats = []
+        self.decisions = []
+        self.pages = dict()
+        self.task_count = 0
+
+    def add_activity_task(self, task_list, activity_id, input=None):
+        """Add an activity task.
+
+        Args:
+            task_list (str): the name of the task list.
+            activity_id (str): the id of the activity.
+            input (dict): the input of the activity.
+        Return:
+            str: the task token.
+        """
+
+        self.task_count += 1
+        task_token = 'activity-{}'.format(self.task_count)
+        self.activity_tasks[task_list].append(dict(
+            activityId=activity_id,
+            taskToken=task_token,
+            input=json.dumps(input or {})))
+        return task_token
+
+    def add_decision_task(self, task_list, poll):
+        """Add a decision task.
+
+        Args:
+            task_list (str): the name of the task list.
+            poll (dict): the decision task (events, workflow execution...)
+        Return:
+            str: the task token.
+        """
+
+        self.task_count += 1
+        task_token = 'decision-{}'.format(self.task_count)
+        self.decision_tasks[task_list].append(
+            dict(poll, taskToken=task_token))
+        return task_token
+
+    async def wait_for_task(self, tasks):
+        """Wait for a task of a task list.
+
+        Args:
+            tasks (deque): the tasks of the task list.
+        Return:
+            dict: the task (empty if none has been added in time.)
+        """
+
+        deadline = time.monotonic() + self.poll_timeout
+        while not tasks:
+            if time.monotonic() >= deadline:
+                return dict()
+            await asyncio.sleep(self.poll_interval)
+        return tasks.popleft()
+
+    async def poll_for_activity_task(self, **kwargs):
+        return await self.wait_for_task(
+            self.activity_tasks[kwargs['taskList']['name']])
+
+    async def respond_activity_task_completed(self, **kwargs):
+        self.completed.append(kwargs)
+        return dict()
+
+    async def respond_activity_task_failed(self, **kwargs):
+        self.failed.append(kwargs)
+        return dict()
+
+    async def record_activity_task_heartbeat(self, **kwargs):
+        self.heartbeats.append(kwargs)
+        return dict(cancelRequested=False)
+
+    async def poll_for_decision_task(self, **kwargs):
+        token = kwargs.get('nextPageToken')
+        if token:
+            return self.pages.pop(token)
+
+        task = await self.wait_for_task(
+            self.decision_tasks[kwargs['taskList']['name']])
+        if not task:
+            return task
+
+        # The events are paged like SWF does: the page size and the order
+        # are the ones of the poll.
+        events = task.get('events', [])
+        if kwargs.get('reverseOrder'):
+            events = events[::-1]
+        size = kwargs.get('maximumPageSize') or len(events) or 1
+        pages = [events[i:i + size] for i in range(0, len(events), size)]
+
+        poll = page = dict(task, events=pages[0] if pages else [])
+        for index, events in enumerate(pages[1:], 1):
+            token = '{}-{}'.format(task['taskToken'], index)
+            page['nextPageToken'] = token
+            page = self.pages[token] = dict(events=events)
+        return poll
+
+    async def respond_decision_task_completed(self, **kwargs):
+        self.decisions.append(kwargs)
+        return dict()
+
+
+class BlockingClient:
+
+    def __init__(self, client, loop):
+        """Create a blocking client from an async client.
+
+        The blocking client is used by the code that runs in the thread pool
+        (activity heartbeats, pages of decision tasks): the calls are made on
+        the event loop and their responses waited for.
+
+        Args:
+            client (AsyncClient): the async client.
+            loop (asyncio.AbstractEventLoop): the event loop of the client.
+        """
+
+        self.client = client
+        self.loop = loop
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self.client, name)
+
+        def call(**kwargs):
+            return asyncio.run_coroutine_threadsafe(
+                method(**kwargs), self.loop).result()
+
+        return call
+
+
+async def run_activity(current_activity, client, identity=None, executor=None):
+    """Poll, execute and respond to one activity task.
+
+    This is the coroutine version of `Activity.run`: the activity is executed
+    in the executor.
+
+    Args:
+        current_activity (Activity): the activity.
+        client (AsyncClient): the async client.
+        identity (str): Identity of the worker making the request.
+        executor (concurrent.futures.Executor): the executor that executes
+            the activity (defaults to the executor of the event loop.)
+    Return:
+        boolean: Always return true, so any loop on run can act as a long
+            running process.
+    """
+
+    loop = asyncio.get_running_loop()
+    additional_params = {}
+    if identity:
+        additional_params.update(identity=identity)
+
+    try:
+        poll = await client.poll_for_activity_task(
+            domain=current_activity.domain,
+            taskList=dict(name=current_activity.task_list),
+            **additional_params)
+    except Exception as error:
+        if current_activity.on_exception:
+            current_activity.on_exception(current_activity, error)
+        current_activity.logger.error(error, exc_info=True)
+        return True
+
+    execution = activity.ActivityExecution(
+        BlockingClient(client, loop), poll.get('activityId'),
+        poll.get('taskToken'), poll.get('input'))
+    if not execution.activity_id:
+        return True
+
+    # Several executions of the same activity run at the same time: the log
+    # context is set on the execution (which is passed to the tasks.)
+    execution.set_log_context(execution.context)
+
+    try:
+        result = await loop.run_in_executor(
+            executor, current_activity.execute_activity, execution)
+        await client.respond_activity_task_completed(
+            taskToken=execution.task_token,
+            result=json.dumps(result))
+    except Exception as error:
+        try:
+            await client.respond_activity_task_failed(
+                taskToken=execution.task_token,
+                reason=str(error)[:255])
+            if current_activity.on_exception:
+                current_activity.on_exception(current_activity, error)
+        except Exception as error2:
+            if current_activity.on_exception:
+                current_activity.on_exception(current_activity, error2)
+
+    return True
+
+
+async def run_decider(decider, client, identity=None, executor=None):
+    """Poll, decide and respond to one decision task.
+
+    This is the coroutine version of `DeciderWorker.run`: the decisions are
+    made in the executor (the next pages of events are polled through the
+    event loop.)
+
+    Args:
+        decider (DeciderWorker): the decider.
+        client (AsyncClient): the async client.
+        identity (str): Identity of the worker making the request.
+        executor (concurrent.futures.Executor): the executor that makes the
+            decisions (defaults to the executor of the event loop.)
+    Return:
+        boolean: Always return true, so any loop on run can act as a long
+            running process.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        poll = await client.poll_for_decision_task(
+            domain=decider.domain,
+            taskList=dict(name=decider.task_list),
+            identity=identity or '',
+            **decider.poll_options)
+
+        if 'events' not in poll:
+            return True
+
+        blocking_decider = copy.copy(decider)
+        blocking_decider.client = BlockingClient(client, loop)
+        decisions = await loop.run_in_executor(
+            executor, blocking_decider.decide, poll, identity)
+
+        await client.respond_decision_task_completed(
+            taskToken=poll.get('taskToken'),
+            decisions=decisions)
+    except Exception as error:
+        if decider.on_exception:
+            decider.on_exception(decider, error)
+        decider.logger.error(error, exc_info=True)
+
+    return True
+
+
+async def serve_activity(
+        current_activity, client, pollers=1, identity=None, executor=None):
+    """Run the loops of an activity (until they stop.)
+
+    Args:
+        current_activity (Activity): the activity.
+        client (AsyncClient): the async client.
+        pollers (int): the number of concurrent polls.
+        identity (str): Identity of the worker making the requests.
+        executor (concurrent.futures.Executor): the executor that executes
+            the activity.
+    """
+
+    async def loop():
+        while await run_activity(
+                current_activity, client, identity=identity,
+                executor=executor):
+            continue
+
+    await asyncio.gather(*[loop() for poller in range(pollers)])
+
+
+async def serve_activities(
+        flow, client, activities=None, pollers=1, identity=None,
+        executor=None):
+    """Run the loops of all the activities of a flow (until they stop.)
+
+    External activities are not run.
+
+    Args:
+        flow (module): the flow module.
+        client (AsyncClient): the async client.
+        activities (list): optional names of the activities to run.
+        pollers (int): the number of concurrent polls per activity.
+        identity (str): Identity of the worker making the requests.
+        executor (concurrent.futures.Executor): the executor that executes
+            the activities.
+    """
+
+    await asyncio.gather(*[
+        serve_activity(
+            current_activity, client, pollers=pollers, identity=identity,
+            executor=executor)
+        for current_activity in activity.find_workflow_activities(flow)
+        if not isinstance(current_activity, activity.ExternalActivity) and (
+            not activities or current_activity.name in activities)])
+
+
+async def serve_decider(
+        decider, client, pollers=1, identity=None, executor=None):
+    """Run the loops of a decider (until they stop.)
+
+    Args:
+        decider (DeciderWorker): the decider.
+        client (AsyncClient): the async client.
+        pollers (int): the number of concurrent polls.
+        identity (str): Identity of the worker making the requests.
+        executor (concurrent.futures.Executor): the executor that makes the
+            decisions.
+    """
+
+    async def loop():
+        while await run_decider(
+                decider, client, identity=identity, executor=executor):
+            continue
+
+    await asyncio.gather(*[loop() for poller in range(pollers)])
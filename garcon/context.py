@@ -10,6 +10,13 @@ events of an execution.
 import json
 
 
+# Keys of the workflow execution info (see `set_workflow_execution_info`.)
+EXECUTION_KEYS = (
+    'execution.domain',
+    'execution.run_id',
+    'execution.workflow_id')
+
+
 class ExecutionContext:
 
     def __init__(self, events=None):
@@ -25,6 +32,7 @@ class ExecutionContext:
 
         self.current = {}
         self.workflow_input = {}
+        self.revision = 0
 
         if events:
             for event in events:
@@ -46,6 +54,20 @@ class ExecutionContext:
         elif event_type == 'WorkflowExecutionStarted':
             self.set_execution_input(event)
 
+    @property
+    def fingerprint(self):
+        """Return the fingerprint of the context.
+
+        The fingerprint changes every time the context is updated through the
+        execution context (the `current` values should not be changed
+        directly.) It allows to memoize values computed from the context.
+
+        Return:
+            tuple: the fingerprint.
+        """
+
+        return (id(self), self.revision)
+
     def set_workflow_execution_info(self, execution_info, domain):
         """Add the workflow execution info.
 
@@ -63,6 +85,7 @@ class ExecutionContext:
                 'runId' in execution_info['workflowExecution']):
 
             workflow_execution = execution_info['workflowExecution']
+            self.revision += 1
             self.current.update({
                 'execution.domain': domain,
                 'execution.workflow_id': workflow_execution['workflowId'],
@@ -84,8 +107,21 @@ class ExecutionContext:
         if result:
             result = json.loads(result)
             self.workflow_input = result
+            self.revision += 1
             self.current.update(result)
 
+    def restore(self, current, workflow_input):
+        """Restore the context of a previous run.
+
+        Args:
+            current (dict): the current values of the previous run.
+            workflow_input (dict): the workflow input of the previous run.
+        """
+
+        self.revision += 1
+        self.current.update(current)
+        self.workflow_input = workflow_input
+
     def add_activity_result(self, activity_event):
         """Add an activity result.
 
@@ -101,4 +137,15 @@ class ExecutionContext:
         result = attributes.get('result')
 
         if result:
-            self.current.update(json.loads(result))
+            self.add_result(json.loads(result))
+
+    def add_result(self, result):
+        """Add a decoded activity result.
+
+        Args:
+            result (dict): the result of the activity.
+        """
+
+        if result:
+            self.revision += 1
+            self.current.update(result)
@@ -7,31 +7,125 @@ The decider worker is focused on orchestrating which activity needs to be
 executed and when based on the flow procided.
 """
 
+from concurrent import futures
+import collections
 import functools
+import importlib
 import json
+import os
+import threading
+import time
+import types
 import uuid
+import zlib
 
 from garcon import activity
+from garcon import context
 from garcon import event
 from garcon import log
+from garcon import utils
+
+
+CLOSING_DECISIONS = (
+    'CompleteWorkflowExecution',
+    'FailWorkflowExecution',
+    'CancelWorkflowExecution',
+    'ContinueAsNewWorkflowExecution')
+
+EXECUTION_KEYS = context.EXECUTION_KEYS
+
+MAXIMUM_PAGE_SIZE = 1000
+
+# SWF fails a run once its history has 25,000 events: by default, runs are
+# continued as new well before that limit.
+DEFAULT_CONTINUE_AS_NEW_EVENTS = 20000
+
+# Delay (in seconds) of the timer that triggers the next chunk of a budgeted
+# scheduling.
+DEFAULT_SCHEDULE_TIMER = 1
+
+# Maximum size of a workflow execution input.
+MAXIMUM_INPUT_SIZE = 32768
+
+# Attributes of the workflow execution start kept when a run continues as new.
+CONTINUE_AS_NEW_ATTRIBUTES = (
+    'childPolicy',
+    'executionStartToCloseTimeout',
+    'lambdaRole',
+    'tagList',
+    'taskList',
+    'taskPriority',
+    'taskStartToCloseTimeout')
+
+DEFAULT_POLLERS = 4
+
+# Deciders of the worker processes of a ProcessDeciderPool (by flow name.)
+process_deciders = dict()
+
+# Events that can change the decisions of a workflow. When none of them has
+# been recorded since the previous decision, there is nothing new to decide.
+SCHEDULING_EVENTS = frozenset([
+    'WorkflowExecutionStarted',
+    'WorkflowExecutionSignaled',
+    'WorkflowExecutionCancelRequested',
+    'ActivityTaskCompleted',
+    'ActivityTaskFailed',
+    'ActivityTaskTimedOut',
+    'ActivityTaskCanceled',
+    'TimerFired',
+    'DecisionTaskTimedOut',
+    'ScheduleActivityTaskFailed',
+    'StartTimerFailed',
+    'RecordMarkerFailed',
+    'CompleteWorkflowExecutionFailed',
+    'FailWorkflowExecutionFailed',
+    'ContinueAsNewWorkflowExecutionFailed'])
+
 
 class DeciderWorker(log.GarconLogger):
 
-    def __init__(self, flow, register=True):
+    def __init__(self, flow, register=True, history_cache=None):
         """Initialize the Decider Worker.
 
+        The flow can define when a run is continued as new (see
+        `continue_as_new`): `continue_as_new_events` is the number of events
+        after which a run is continued (20,000 by default, 0 to never continue
+        runs), and `continue_as_new_context_size` the size of the encoded
+        context after which a run is continued (not set by default.) It can
+        also define `snapshot_interval`: the number of events after which a
+        snapshot of the run history is recorded (see `record_snapshot`), and
+        the scheduling budget of a decision (see `create_decisions_from_flow`)
+        with `schedule_budget` (a number of activity instances),
+        `schedule_time_budget` (in seconds) and `schedule_timer` (the delay
+        before the next chunk is scheduled, 1 second by default.)
+
         Args:
             flow (module): Flow module.
             register (boolean): If this flow needs to be register on AWS.
+            history_cache (HistoryCache): optional cache of the run histories.
+                When provided, the decider keeps the folded history of each
+                run between two decisions and only retrieves and replays the
+                events it has not seen yet.
         """
 
         self.client = flow.client
         self.flow = flow
         self.domain = flow.domain
         self.version = getattr(flow, 'version', '1.0')
-        self.activities = activity.find_workflow_activities(flow)
+        self.compiled_flow = activity.CompiledFlow(flow)
+        self.activities = self.compiled_flow.activities
         self.task_list = flow.name
         self.on_exception = getattr(flow, 'on_exception', None)
+        self.history_cache = history_cache
+        self.continue_as_new_events = getattr(
+            flow, 'continue_as_new_events', DEFAULT_CONTINUE_AS_NEW_EVENTS)
+        self.continue_as_new_context_size = getattr(
+            flow, 'continue_as_new_context_size', None)
+        self.snapshot_interval = getattr(flow, 'snapshot_interval', None)
+        self.schedule_budget = getattr(flow, 'schedule_budget', None)
+        self.schedule_time_budget = getattr(flow, 'schedule_time_budget', None)
+        self.schedule_timer = getattr(
+            flow, 'schedule_timer', DEFAULT_SCHEDULE_TIMER)
 
         if register:
             self.register()
@@ -64,6 +158,129 @@ class DeciderWorker(log.GarconLogger):
         # Remove all the events that are related to decisions and only.
         return [e for e in events if not e['eventType'].startswith('Decision')]
 
+    @property
+    def poll_options(self):
+        """Options used on every decision task poll (including the pages.)
+
+        Return:
+            dict: the additional poll options.
+        """
+
+        options = dict(maximumPageSize=MAXIMUM_PAGE_SIZE)
+        if self.history_cache is not None:
+            options.update(reverseOrder=True)
+        return options
+
+    def get_run_history(self, identity, poll):
+        """Get the folded history of a run.
+
+        The pages of events are folded into the run history as they arrive,
+        so the raw events are never accumulated in memory.
+
+        When a history cache is used, only the events that are newer than the
+        last event folded in are retrieved: the decision tasks are polled in
+        reverse order, so paging stops as soon as those events have been
+        collected. On a cache miss, the history is restored from the latest
+        snapshot marker (see `record_snapshot`), and only the events that
+        follow it are retrieved (without marker, the full history is.) The run
+        history is taken out of the cache until the decisions have been made
+        (see `decide`.)
+
+        Args:
+            identity (string): The identity of the decider that pulls the
+                information.
+            poll (object): The poll object (see AWS SWF for details.)
+        Return:
+            RunHistory: the history of the run.
+        """
+
+        if self.history_cache is None:
+            run_history = event.RunHistory()
+            while True:
+                run_history.add_events(poll.get('events', []))
+                if 'nextPageToken' not in poll:
+                    return run_history
+                poll = self.poll_next_page(identity, poll['nextPageToken'])
+
+        run_id = poll.get('workflowExecution', {}).get('runId')
+        run_history = self.history_cache.pop(run_id)
+        find_snapshot = run_history is None
+        if run_history is None:
+            run_history = event.RunHistory()
+
+        # Pages come in reverse order: the new events are collected until the
+        # last folded event is reached, and folded at once in order. On a
+        # cache miss, the history starts from the latest snapshot marker.
+        events = []
+        while True:
+            page = poll.get('events', [])
+            if find_snapshot:
+                snapshot = event.find_snapshot(page)
+                if snapshot is not None:
+                    run_history.restore(snapshot)
+                    find_snapshot = False
+
+            events += [
+                e for e in page
+                if e['eventId'] > run_history.last_event_id]
+
+            if ('nextPageToken' not in poll or
+                    any(e['eventId'] <= run_history.last_event_id
+                        for e in page)):
+                break
+            poll = self.poll_next_page(identity, poll['nextPageToken'])
+
+        run_history.add_events(events)
+        return run_history
+
+    def poll_next_page(self, identity, next_page_token):
+        """Poll the next page of events of a decision task.
+
+        Args:
+            identity (string): The identity of the decider that pulls the
+                information.
+            next_page_token (str): the token of the page.
+        Return:
+            dict: the page.
+        """
+
+        return self.client.poll_for_decision_task(
+            domain=self.domain,
+            identity=identity,
+            taskList=dict(name=self.task_list),
+            nextPageToken=next_page_token,
+            **self.poll_options)
+
+    def has_scheduling_events(self, poll):
+        """Check if new events can change the decisions.
+
+        The events recorded after the previous decision (the ones after
+        `previousStartedEventId`) are compared against the events that can
+        affect the scheduling (completions, failures, timeouts, signals...)
+        This can only be answered without retrieving the full history when
+        the first page contains all the new events, otherwise the events are
+        assumed to be relevant.
+
+        Args:
+            poll (object): The poll object (see AWS SWF for details.)
+        Return:
+            boolean: False if none of the new events can affect the decisions.
+        """
+
+        previous_event_id = poll.get('previousStartedEventId')
+        if not previous_event_id:
+            return True
+
+        events = poll.get('events', [])
+        if 'nextPageToken' in poll and (
+                self.history_cache is None or
+                not any(e['eventId'] <= previous_event_id for e in events)):
+            return True
+
+        return any(
+            e['eventType'] in SCHEDULING_EVENTS
+            for e in events if e['eventId'] > previous_event_id)
+
     def get_activity_states(self, history):
         """Get the activity states from the history.
 
@@ -120,24 +337,45 @@ class DeciderWorker(log.GarconLogger):
         can be provided at the activity level. Discovery of the next activity
         to schedule is thus very straightforward.
 
+        When the flow defines a scheduling budget, at most `schedule_budget`
+        instances are scheduled, for at most `schedule_time_budget` seconds.
+        The instances that are left are scheduled by the next decisions: a
+        timer is started so there is a next decision even if no activity
+        closes in between (the instances that have been scheduled are
+        recorded in the history, and are not available anymore.)
+
         Args:
             decisions (list): the layer decision for swf.
             activity_states (dict): all the state activities.
             context (dict): the context of the activities.
         """
 
+        instance_cache = activity.InstanceCache(context.fingerprint)
+        budget = ScheduleBudget(
+            self.schedule_budget, self.schedule_time_budget)
+
         try:
-            for current in activity.find_available_activities(
-                    self.flow, activity_states, context.current):
-                schedule_activity_task(
-                    decisions, current, version=self.version)
-            else:
-                activities = list(
-                    activity.find_uncomplete_activities(
-                        self.flow, activity_states, context.current))
-                if not activities:
-                    decisions.append(dict(
-                        decisionType='CompleteWorkflowExecution'))
+            schedule_activity_tasks(
+                decisions,
+                budget.limit(activity.find_available_activities(
+                    self.compiled_flow, activity_states, context.current,
+                    instance_cache=instance_cache)),
+                version=self.version,
+                history=activity_states)
+
+            if budget.exhausted:
+                decisions.append(dict(
+                    decisionType='StartTimer',
+                    startTimerDecisionAttributes=dict(
+                        timerId='garcon.schedule.{}'.format(uuid.uuid4().hex),
+                        startToFireTimeout=str(self.schedule_timer))))
+
+            uncomplete = activity.find_uncomplete_activities(
+                self.compiled_flow, activity_states, context.current,
+                instance_cache=instance_cache)
+            if next(uncomplete, None) is None:
+                decisions.append(dict(
+                    decisionType='CompleteWorkflowExecution'))
         except Exception as e:
             decisions.append(dict(
                 decisionType='FailWorkflowExecution',
@@ -215,11 +453,30 @@ class DeciderWorker(log.GarconLogger):
                 running process.
         """
 
+        poll = self.poll(identity)
+        if poll is None:
+            return True
+
+        decisions = self.decide(poll, identity)
+        self.respond(poll, decisions)
+        return True
+
+    def poll(self, identity=None):
+        """Poll for a decision task.
+
+        Args:
+            identity (str): Identity of the worker making the request.
+        Return:
+            dict: the poll object (None if the poll has failed or if there is
+                no decision task to handle.)
+        """
+
         try:
             poll = self.client.poll_for_decision_task(
                 domain=self.domain,
                 taskList=dict(name=self.task_list),
-                identity=identity or '')
+                identity=identity or '',
+                **self.poll_options)
         except Exception as error:
             # Catch exceptions raised during poll() to avoid a Decider thread
             # dying & the daemon unable to process subsequent workflows.
@@ -231,30 +488,314 @@ class DeciderWorker(log.GarconLogger):
             if self.on_exception:
                 self.on_exception(self, error)
             self.logger.error(error, exc_info=True)
-            return True
-
-        custom_decider = getattr(self.flow, 'decider', None)
+            return None
 
         if 'events' not in poll:
-            return True
+            return None
+        return poll
+
+    def decide(self, poll, identity=None):
+        """Create the decisions of a decision task.
+
+        Args:
+            poll (dict): the poll object (see AWS SWF for details.)
+            identity (str): Identity of the worker making the request.
+        Return:
+            list: the decisions.
+        """
+
+        if not self.has_scheduling_events(poll):
+            return []
 
-        history = self.get_history(identity or '', poll)
-        activity_states = self.get_activity_states(history)
-        current_context = event.get_current_context(history)
+        custom_decider = getattr(self.flow, 'decider', None)
+        run_history = self.get_run_history(identity or '', poll)
+        activity_states = run_history.activity_states
+        current_context = run_history.context
         current_context.set_workflow_execution_info(poll, self.domain)
 
         decisions = []
         if not custom_decider:
             self.create_decisions_from_flow(
                 decisions, activity_states, current_context)
+
+            if not is_closing(decisions):
+                continue_decision = self.continue_as_new(run_history)
+                if continue_decision:
+                    decisions = [continue_decision]
+                else:
+                    self.record_snapshot(decisions, run_history)
         else:
             self.delegate_decisions(
                 decisions, custom_decider, activity_states, current_context)
+
+        # The run history is only put back in the cache once the decisions
+        # have been made, so a run is never decided on concurrently from the
+        # same history.
+        if self.history_cache is not None and not is_closing(decisions):
+            self.history_cache.set(
+                poll.get('workflowExecution', {}).get('runId'), run_history)
+        return decisions
+
+    def continue_as_new(self, run_history):
+        """Create the decision that continues a run as a new run.
+
+        A run is continued as new when its history has reached
+        `continue_as_new_events` events, or when its encoded context has
+        reached `continue_as_new_context_size`. The context and the completed
+        activities are carried in the input of the new run (see
+        `RunHistory.snapshot`), so its history starts from a single event.
+
+        Runs are only continued when no activity is in flight (the results of
+        activities in flight would be lost), and when the carried state fits
+        in the input of a run. Runs of custom deciders are never continued.
+
+        Args:
+            run_history (RunHistory): the history of the run.
+        Return:
+            dict: the decision (None if the run should not be continued.)
+        """
+
+        max_events = self.continue_as_new_events
+        max_size = self.continue_as_new_context_size
+        if not max_events and not max_size:
+            return None
+
+        if run_history.has_activities_in_flight():
+            return None
+
+        if not max_events or run_history.last_event_id < max_events:
+            if not max_size or len(json.dumps(
+                    run_history.context.current)) < max_size:
+                return None
+
+        execution_input = json.dumps({
+            event.CONTINUED_STATE_KEY: utils.compress(
+                run_history.snapshot(self.activities))})
+
+        if len(execution_input) > MAXIMUM_INPUT_SIZE:
+            self.logger.warning(
+                'The state of the run is too large to continue as new '
+                '({} characters.)'.format(len(execution_input)))
+            return None
+
+        attributes = dict(input=execution_input)
+        start_attributes = run_history.start_attributes
+        for key in CONTINUE_AS_NEW_ATTRIBUTES:
+            if key in start_attributes:
+                attributes[key] = start_attributes[key]
+        if 'workflowType' in start_attributes:
+            attributes.update(
+                workflowTypeVersion=start_attributes['workflowType'].get(
+                    'version'))
+
+        return dict(
+            decisionType='ContinueAsNewWorkflowExecution',
+            continueAsNewWorkflowExecutionDecisionAttributes=attributes)
+
+    def record_snapshot(self, decisions, run_history):
+        """Record a snapshot of the run history in a marker.
+
+        A snapshot is recorded every `snapshot_interval` events. When a
+        history cache is used and the history of a run is not in it (for
+        instance after a restart, or when the run is decided on by another
+        host), only the events that follow the latest snapshot are retrieved
+        and replayed (see `get_run_history`.) The marker is added before the
+        other decisions.
+
+        Args:
+            decisions (list): the decisions.
+            run_history (RunHistory): the history of the run.
+        """
+
+        interval = self.snapshot_interval
+        if not interval or (
+                run_history.last_event_id - run_history.snapshot_event_id <
+                interval):
+            return
+
+        snapshot = run_history.snapshot(self.activities)
+        snapshot.update(
+            last_event_id=run_history.last_event_id,
+            start_attributes=run_history.start_attributes)
+        details = utils.compress(snapshot)
+
+        if len(details) > MAXIMUM_INPUT_SIZE:
+            self.logger.warning(
+                'The snapshot of the run is too large to be recorded '
+                '({} characters.)'.format(len(details)))
+            return
+
+        run_history.snapshot_event_id = run_history.last_event_id
+        decisions.insert(0, dict(
+            decisionType='RecordMarker',
+            recordMarkerDecisionAttributes=dict(
+                markerName=event.SNAPSHOT_MARKER,
+                details=details)))
+
+    def respond(self, poll, decisions):
+        """Respond to a decision task.
+
+        Args:
+            poll (dict): the poll object (see AWS SWF for details.)
+            decisions (list): the decisions.
+        """
+
         self.client.respond_decision_task_completed(
             taskToken=poll.get('taskToken'),
             decisions=decisions)
+
+
+class DeciderPool(log.GarconLogger):
+
+    def __init__(
+            self, flow, pollers=DEFAULT_POLLERS, register=True,
+            history_cache=None):
+        """Create a pool of deciders.
+
+        The pool keeps several decision task polls outstanding (one per
+        poller thread) and makes the decisions of the different workflow
+        executions in parallel. All the pollers share the same decider (and
+        the same compiled flow.) The run histories are isolated: a cached run
+        history is only used by one decision at a time.
+
+        Args:
+            flow (module): Flow module.
+            pollers (int): the number of concurrent pollers.
+            register (boolean): If this flow needs to be register on AWS.
+            history_cache (HistoryCache): optional cache of the run histories.
+        """
+
+        self.decider = DeciderWorker(
+            flow, register=register, history_cache=history_cache)
+        self.pollers = pollers
+
+    def run(self, identity=None):
+        """Run the pollers (until they stop.)
+
+        Args:
+            identity (str): Identity of the workers making the requests.
+        """
+
+        threads = []
+        for poller in range(self.pollers):
+            thread = threading.Thread(
+                target=decider_runner,
+                args=(self, identity))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+    def run_once(self, identity=None):
+        """Poll, decide and respond to one decision task.
+
+        Args:
+            identity (str): Identity of the worker making the request.
+        Return:
+            boolean: Always return true, so any loop on run can act as a long
+                running process.
+        """
+
+        poll = self.decider.poll(identity)
+        if poll is None:
+            return True
+
+        try:
+            decisions = self.decide(poll, identity)
+            self.decider.respond(poll, decisions)
+        except Exception as error:
+            if self.decider.on_exception:
+                self.decider.on_exception(self.decider, error)
+            self.logger.error(error, exc_info=True)
         return True
 
+    def decide(self, poll, identity=None):
+        """Create the decisions of a decision task.
+
+        Args:
+            poll (dict): the poll object (see AWS SWF for details.)
+            identity (str): Identity of the worker making the request.
+        Return:
+            list: the decisions.
+        """
+
+        return self.decider.decide(poll, identity)
+
+
+class ProcessDeciderPool(DeciderPool):
+
+    def __init__(
+            self, flow, pollers=DEFAULT_POLLERS, processes=None,
+            register=True, mp_context=None):
+        """Create a pool of deciders that decide in separate processes.
+
+        The decision task polls are made by threads of this process, and the
+        histories are folded and the decisions made in worker processes, so
+        the decisions are not bound by the GIL. Each run is always sent to the
+        same process, which keeps the run histories in its own cache.
+
+        Args:
+            flow (module): Flow module (it needs to be importable by the
+                processes.)
+            pollers (int): the number of concurrent pollers.
+            processes (int): the number of processes (defaults to the number
+                of cpus.)
+            register (boolean): If this flow needs to be register on AWS.
+            mp_context (multiprocessing.context): the multiprocessing context
+                used to start the processes.
+
+        Raises:
+            ValueError: if the flow is not a module.
+        """
+
+        if not isinstance(flow, types.ModuleType):
+            raise ValueError(
+                'The flow of a process decider pool should be a module.')
+
+        # The pages of events are polled in reverse order, as expected by the
+        # history cache of the processes.
+        DeciderPool.__init__(
+            self, flow, pollers=pollers, register=register,
+            history_cache=event.HistoryCache(max_runs=0))
+
+        self.flow_name = flow.__name__
+        self.executors = [
+            futures.ProcessPoolExecutor(max_workers=1, mp_context=mp_context)
+            for process in range(processes or os.cpu_count() or 1)]
+
+    def run(self, identity=None):
+        """Run the pollers (until they stop) and shut the processes down.
+
+        Args:
+            identity (str): Identity of the workers making the requests.
+        """
+
+        try:
+            DeciderPool.run(self, identity)
+        finally:
+            for executor in self.executors:
+                executor.shutdown()
+
+    def decide(self, poll, identity=None):
+        """Create the decisions of a decision task in a process.
+
+        Args:
+            poll (dict): the poll object (see AWS SWF for details.)
+            identity (str): Identity of the worker making the request.
+        Return:
+            list: the decisions.
+        """
+
+        if not self.decider.has_scheduling_events(poll):
+            return []
+
+        run_id = poll.get('workflowExecution', {}).get('runId') or ''
+        executor = self.executors[
+            zlib.crc32(run_id.encode('utf-8')) % len(self.executors)]
+        return executor.submit(
+            decide_in_process, self.flow_name, poll, identity).result()
+
 
 class ScheduleContext:
     """
@@ -282,6 +823,99 @@ class ScheduleContext:
         self.completed = False
 
 
+class ScheduleBudget:
+    """
+    Schedule Budget
+    ===============
+
+    The schedule budget limits the number of activity instances scheduled by
+    a decision, and the time spent scheduling them.
+    """
+
+    def __init__(self, count=None, seconds=None):
+        """Create a schedule budget.
+
+        Args:
+            count (int): the maximum number of instances (no limit if None.)
+            seconds (float): the maximum time spent scheduling instances (no
+                limit if None.)
+        """
+
+        self.count = count
+        self.seconds = seconds
+        self.exhausted = False
+
+    def limit(self, instances):
+        """Limit instances to the budget.
+
+        The budget is marked as exhausted when instances are left.
+
+        Args:
+            instances (iterable): the activity instances.
+        Yield:
+            ActivityInstance: the instances within the budget.
+        """
+
+        deadline = None
+        if self.seconds:
+            deadline = time.monotonic() + self.seconds
+
+        for index, instance in enumerate(instances):
+            if (self.count and index >= self.count) or (
+                    deadline and time.monotonic() >= deadline):
+                self.exhausted = True
+                return
+            yield instance
+
+
+def decider_runner(pool, identity=None):
+    """Run indefinitely the decisions of a pool.
+
+    Args:
+        pool (DeciderPool): the decider pool.
+        identity (str): Identity of the worker making the requests.
+    """
+
+    while (pool.run_once(identity)):
+        continue
+
+
+def decide_in_process(flow_name, poll, identity=None):
+    """Create the decisions of a decision task (in a worker process.)
+
+    The deciders are created once per process, with their own history cache.
+
+    Args:
+        flow_name (str): the name of the flow module.
+        poll (dict): the poll object (see AWS SWF for details.)
+        identity (str): Identity of the worker making the request.
+    Return:
+        list: the decisions.
+    """
+
+    decider = process_deciders.get(flow_name)
+    if decider is None:
+        decider = DeciderWorker(
+            importlib.import_module(flow_name), register=False,
+            history_cache=event.HistoryCache())
+        process_deciders[flow_name] = decider
+    return decider.decide(poll, identity)
+
+
+def is_closing(decisions):
+    """Check if a list of decisions closes the workflow execution.
+
+    Args:
+        decisions (list): the decisions.
+    Return:
+        boolean: if one of the decisions closes the execution.
+    """
+
+    return any(
+        decision.get('decisionType') in CLOSING_DECISIONS
+        for decision in decisions)
+
+
 def schedule_activity_task(
         decisions, instance, version='1.0', id=None):
     """Schedule an activity task.
@@ -305,17 +939,334 @@ def schedule_activity_task(
             heartbeatTimeout=str(instance.heartbeat_timeout),
             startToCloseTimeout=str(instance.timeout),
             scheduleToStartTimeout=str(instance.schedule_to_start),
-            scheduleToCloseTimeout=str(instance.schedule_to_close))))
+            scheduleToCloseTimeout=str(instance.schedule_to_close),
+            **task_priority(instance))))
+
+
+def task_priority(instance):
+    """Get the task priority attribute of an activity instance.
+
+    Args:
+        instance (ActivityInstance): the activity instance.
+    Return:
+        dict: the task priority attribute (empty if the instance has no
+            priority.)
+    """
+
+    if instance.priority is None:
+        return dict()
+    return dict(taskPriority=str(instance.priority))
+
+
+def schedule_activity_tasks(decisions, instances, version='1.0', history=None):
+    """Schedule activity tasks in bulk.
+
+    The decision attributes that only depend on the activity (type, task
+    list and timeouts) are built once per activity. The part of the input
+    that comes from the execution context is shared by all the instances of
+    an activity: it is encoded once, and the local context of each instance
+    is spliced in.
+
+    The instances of the activities that define a batch size are packed in
+    batches (see `ActivityBatch`.)
+
+    Args:
+        decisions (list): the layer decision for swf.
+        instances (iterable): the activity instances to schedule.
+        version (str): the version of the activity instances.
+        history (dict): the activity states (used to adapt the size of the
+            batches.)
+    """
+
+    encoder = ExecutionInputEncoder()
+    templates = dict()
+    batch_sizes = dict()
+    batch = None
+
+    for instance in instances:
+        template_key = (
+            instance.activity_name, instance.timeout,
+            instance.heartbeat_timeout, instance.schedule_to_start,
+            instance.priority)
+        template = templates.get(template_key)
+
+        if template is None:
+            template = dict(
+                activityType=dict(
+                    name=instance.activity_name,
+                    version=version),
+                taskList=dict(name=instance.activity_worker.task_list),
+                heartbeatTimeout=str(instance.heartbeat_timeout),
+                startToCloseTimeout=str(instance.timeout),
+                scheduleToStartTimeout=str(instance.schedule_to_start),
+                scheduleToCloseTimeout=str(instance.schedule_to_close),
+                **task_priority(instance))
+            templates[template_key] = template
+
+        batch_size = batch_sizes.get(instance.activity_name)
+        if batch_size is None:
+            batch_size = activity.get_batch_size(
+                instance.activity_worker,
+                (history or {}).get(instance.activity_name, {}))
+            batch_sizes[instance.activity_name] = batch_size
+
+        shared_input, local_input = encoder.encode_parts(instance)
+
+        if batch_size > 1:
+            if batch is not None and not batch.accepts(
+                    template, shared_input, local_input, instance):
+                batch.schedule(decisions)
+                batch = None
+
+            if batch is None:
+                batch = ActivityBatch(template, shared_input)
+            batch.add(instance, local_input)
+
+            if len(batch) >= batch_size:
+                batch.schedule(decisions)
+                batch = None
+            continue
+
+        attributes = dict(template)
+        attributes.update(
+            activityId=instance.id,
+            input=merge_json_objects(shared_input, json.dumps(local_input)))
+
+        decisions.append(dict(
+            decisionType='ScheduleActivityTask',
+            scheduleActivityTaskDecisionAttributes=attributes))
+
+    if batch is not None:
+        batch.schedule(decisions)
+
+
+class ActivityBatch:
+    """
+    Activity Batch
+    ==============
+
+    A batch packs several instances of an activity in one activity task: the
+    worker runs them one after the other (see `Activity.execute_batch`.) The
+    instances of a batch share the same decision attributes and the same
+    shared input. The ids of the instances are listed in the `control` of
+    the task, so the history knows the instances of a batch.
+    """
+
+    def __init__(self, template, shared_input):
+        """Create a batch.
+
+        Args:
+            template (dict): the decision attributes of the instances.
+            shared_input (str): the encoded shared input of the instances.
+        """
+
+        self.template = template
+        self.shared_input = shared_input
+        self.instances = []
+        self.members = []
+        self.size = len(shared_input) + len(activity.BATCH_KEY) + 8
+
+    def __len__(self):
+        return len(self.instances)
+
+    def accepts(self, template, shared_input, local_input, instance):
+        """Check if an instance can be added to the batch.
+
+        Args:
+            template (dict): the decision attributes of the instance.
+            shared_input (str): the encoded shared input of the instance.
+            local_input (dict): the local input of the instance.
+            instance (ActivityInstance): the instance.
+        Return:
+            boolean: if the instance can be added.
+        """
+
+        return (
+            template is self.template and
+            shared_input == self.shared_input and
+            self.size + len(json.dumps([instance.id, local_input])) + 2 <=
+            MAXIMUM_INPUT_SIZE)
+
+    def add(self, instance, local_input):
+        """Add an instance to the batch.
+
+        Args:
+            instance (ActivityInstance): the instance.
+            local_input (dict): the local input of the instance.
+        """
+
+        member = json.dumps([instance.id, local_input])
+        self.instances.append((instance, local_input))
+        self.members.append(member)
+        self.size += len(member) + 2
+
+    def schedule(self, decisions):
+        """Schedule the batch.
+
+        A batch of one instance is scheduled as the instance itself.
+
+        Args:
+            decisions (list): the layer decision for swf.
+        """
+
+        attributes = dict(self.template)
+        instance, local_input = self.instances[0]
+
+        if len(self.instances) == 1:
+            attributes.update(
+                activityId=instance.id,
+                input=merge_json_objects(
+                    self.shared_input, json.dumps(local_input)))
+        else:
+            ids = [member.id for member, member_input in self.instances]
+            timeout = instance.timeout * len(ids)
+            attributes.update(
+                activityId=activity.create_instance_id(
+                    instance.activity_name, 'batch-{}'.format(
+                        utils.create_canonical_key(dict(instances=ids)))),
+                control=json.dumps({activity.BATCH_KEY: ids}),
+                input=merge_json_objects(
+                    self.shared_input,
+                    '{{"{}": [{}]}}'.format(
+                        activity.BATCH_KEY, ', '.join(self.members))),
+                startToCloseTimeout=str(timeout),
+                scheduleToCloseTimeout=str(
+                    instance.schedule_to_start + timeout))
+
+        decisions.append(dict(
+            decisionType='ScheduleActivityTask',
+            scheduleActivityTaskDecisionAttributes=attributes))
+
+
+class ExecutionInputEncoder:
+    """
+    Execution Input Encoder
+    =======================
+
+    Encodes the execution input of activity instances (see
+    `ActivityInstance.create_execution_input`.) The input is split in two: the
+    values that come from the execution context, which are shared by all the
+    instances created from the same context, and the values of the local
+    context. The shared part is only encoded once.
+    """
+
+    def __init__(self):
+        """Create the encoder.
+        """
+
+        self.shared_inputs = dict()
+
+    def encode(self, instance):
+        """Encode the execution input of an instance.
+
+        Args:
+            instance (ActivityInstance): the activity instance.
+        Return:
+            str: the json input.
+        """
+
+        shared_input, local_input = self.encode_parts(instance)
+        return merge_json_objects(shared_input, json.dumps(local_input))
+
+    def encode_parts(self, instance):
+        """Encode the shared part of the execution input of an instance.
+
+        Args:
+            instance (ActivityInstance): the activity instance.
+        Return:
+            tuple: the json shared input, and the local input (dict.)
+        """
+
+        requirements = instance.description.get('requirements')
+        local_context = instance.local_context
+
+        if requirements is None:
+            local_keys = tuple(local_context)
+        else:
+            local_keys = tuple(
+                key for key in local_context
+                if key in requirements or key in EXECUTION_KEYS)
+
+        # The objects the key refers to are kept along with the encoded value
+        # so their ids cannot be reused while the encoder is alive.
+        key = (id(instance.execution_context), id(requirements), local_keys)
+        shared = self.shared_inputs.get(key)
+        if shared is None:
+            shared = (
+                json.dumps(self.create_shared_input(
+                    instance.execution_context, requirements, local_keys)),
+                instance.execution_context,
+                requirements)
+            self.shared_inputs[key] = shared
+
+        local_input = dict()
+        for key in local_keys:
+            value = local_context[key]
+            if requirements is None or value is not None or (
+                    key in EXECUTION_KEYS):
+                local_input[key] = value
+
+        return shared[0], local_input
+
+    def create_shared_input(self, execution_context, requirements, local_keys):
+        """Create the part of the input that comes from the execution context.
+
+        Args:
+            execution_context (dict): the execution context.
+            requirements (set): the requirements of the runner (None if the
+                full context is sent.)
+            local_keys (tuple): the keys provided by the local context.
+        Return:
+            dict: the shared input.
+        """
+
+        if requirements is None:
+            return {
+                key: value for key, value in execution_context.items()
+                if key not in local_keys}
+
+        shared_input = dict()
+        for requirement in requirements:
+            if requirement in local_keys:
+                continue
+            value = execution_context.get(requirement)
+            if value is not None:
+                shared_input[requirement] = value
+
+        for key in EXECUTION_KEYS:
+            if key not in local_keys:
+                shared_input[key] = execution_context.get(key)
+        return shared_input
+
+
+def merge_json_objects(first, second):
+    """Merge two json encoded objects that do not share any key.
+
+    Args:
+        first (str): the first json object.
+        second (str): the second json object.
+    Return:
+        str: the merged json object.
+    """
+
+    if first == '{}':
+        return second
+    if second == '{}':
+        return first
+    return first[:-1] + ', ' + second[1:]
 
 
 def schedule(
         decisions, schedule_context, history, context, schedule_id,
-        current_activity, requires=None, input=None, version='1.0'):
+        current_activity, requires=None, input=None, version='1.0',
+        max_in_flight=None):
     """Schedule an activity.
 
     Scheduling an activity requires all the requirements to be completed (all
     activities should be marked as completed). The scheduler also mixes the
     input with the full execution context to send the data to the activity.
+    When `max_in_flight` is set, the instances are scheduled in a sliding
+    window: at most `max_in_flight` of them are scheduled and not closed.
 
     Args:
         decisions (list): the layer decision for swf.
@@ -326,6 +1277,8 @@ def schedule(
         current_activity (Activity): the activity to run.
         requires (list): list of all requirements.
         input (dict): additional input for the context.
+        max_in_flight (int): the maximum number of instances in flight
+            (defaults to the one of the activity.)
 
     Throws:
         ActivityInstanceNotReadyException: if one of the activity in the
@@ -339,14 +1292,23 @@ def schedule(
     activity_completed = set()
     result = dict()
 
-    instance_context = dict()
-    instance_context.update(context or {})
-    instance_context.update(input or {})
+    instance_context = collections.ChainMap(input or {}, context or {})
 
+    instances = []
+    in_flight = 0
     for current in current_activity.instances(instance_context):
         current_id = '{}-{}'.format(current.id, schedule_id)
         states = history.get(current.activity_name, {}).get(current_id)
+        if states and states.get_last_state() == activity.ACTIVITY_SCHEDULED:
+            in_flight += 1
+        instances.append((current, current_id, states))
 
+    window = None
+    max_in_flight = max_in_flight or current_activity.max_in_flight
+    if max_in_flight:
+        window = max_in_flight - in_flight
+
+    for current, current_id, states in instances:
         if states:
             if states.get_last_state() == activity.ACTIVITY_COMPLETED:
                 result.update(states.result or dict())
@@ -365,6 +1327,12 @@ def schedule(
 
         activity_completed.add(False)
         schedule_context.mark_uncompleted()
+
+        if window is not None:
+            if window <= 0:
+                continue
+            window -= 1
+
         schedule_activity_task(
             decisions, current, id=current_id, version=version)
 
@@ -1,7 +1,503 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+import json
+import threading
+
 from garcon import activity
 from garcon import context
-import json
+from garcon import utils
+
+
+DEFAULT_CACHE_MAX_RUNS = 100
+DEFAULT_CACHE_MAX_EVENTS = 500000
+
+# Key of the workflow input that carries the state of a continued run.
+CONTINUED_STATE_KEY = 'garcon.continued_state'
+
+# Name of the markers that record snapshots of the run history.
+SNAPSHOT_MARKER = 'garcon.snapshot'
+
+
+class RunHistory:
+
+    def __init__(self):
+        """Create the folded history of a workflow run.
+
+        The run history keeps the activity states and the execution context
+        of one workflow run, along with the id of the last event that has been
+        folded in. New events can be added at any time: events that have
+        already been processed are ignored, which allows the history to be
+        kept between two decisions and only be fed the delta.
+        """
+
+        self.activity_states = dict()
+        self.context = context.ExecutionContext()
+        self.scheduled_events = dict()
+        self.start_attributes = dict()
+        self.last_event_id = 0
+        self.snapshot_event_id = 0
+        self.total_events = 0
+
+    def add_events(self, events):
+        """Fold a list of events into the history.
+
+        Args:
+            events (list): list of events (in any order.)
+        """
+
+        for event in sort_events(events):
+            event_id = event.get('eventId')
+            if event_id <= self.last_event_id:
+                continue
+
+            self.add_event(event)
+            self.last_event_id = event_id
+            self.total_events += 1
+
+    def add_event(self, event):
+        """Reduce an event into the activity states and the context.
+
+        Args:
+            event (dict): the event to add.
+        """
+
+        reducer = self.reducers.get(event.get('eventType'))
+        if reducer:
+            reducer(self, event)
+
+    def has_activities_in_flight(self):
+        """Check if activities have been scheduled and have not closed yet.
+
+        Return:
+            boolean: if at least one activity instance is in flight.
+        """
+
+        return any(
+            states.get_last_state() == activity.ACTIVITY_SCHEDULED
+            for activity_states in self.activity_states.values()
+            for states in activity_states.values())
+
+    def snapshot(self, activities):
+        """Create a compact snapshot of the history.
+
+        The snapshot holds the context (without the execution keys, which are
+        set on every decision), the completed activities, the failure counts
+        of the failed instances (so their retries are preserved) and the
+        activities in flight (by id of their scheduling event.) An activity
+        whose instances have all completed is only recorded by its name.
+
+        Args:
+            activities (list): the activities of the flow.
+        Return:
+            dict: the snapshot (json serializable.)
+        """
+
+        current = self.context.current
+        completed = dict()
+        failures = dict()
+
+        for current_activity in activities:
+            activity_states = self.activity_states.get(current_activity.name)
+            if not activity_states:
+                continue
+
+            if isinstance(activity_states, CompletedActivityStates):
+                completed[current_activity.name] = True
+                continue
+
+            if all(
+                    activity.ACTIVITY_COMPLETED in getattr(
+                        activity_states.get(instance.id), 'states', ())
+                    for instance in current_activity.instances(current)):
+                completed[current_activity.name] = True
+                continue
+
+            completed_ids = []
+            for activity_id, states in activity_states.items():
+                if activity.ACTIVITY_COMPLETED in states.states:
+                    completed_ids.append(activity_id)
+                elif states.get_last_state() == activity.ACTIVITY_FAILED:
+                    failures.setdefault(current_activity.name, {})[
+                        activity_id] = activity.count_activity_failures(states)
+
+            if completed_ids:
+                completed[current_activity.name] = completed_ids
+
+        # Only the last scheduling event of an instance is kept (the previous
+        # ones have failed.)
+        last_scheduled_events = dict()
+        for event_id, scheduled_event in self.scheduled_events.items():
+            for activity_id in (
+                    scheduled_event.get('members') or
+                    [scheduled_event['activity_id']]):
+                last_scheduled_events[(
+                    scheduled_event['activity_name'], activity_id)] = event_id
+
+        # The instances of a batch are recorded with their failure counts.
+        scheduled = dict()
+        for (activity_name, activity_id), event_id in (
+                last_scheduled_events.items()):
+            states = self.activity_states.get(activity_name, {}).get(
+                activity_id)
+            if not states or (
+                    states.get_last_state() != activity.ACTIVITY_SCHEDULED):
+                continue
+
+            failure_count = activity.count_activity_failures(states)
+            scheduled_event = self.scheduled_events[event_id]
+            if 'members' not in scheduled_event:
+                scheduled[event_id] = [
+                    activity_name, activity_id, failure_count]
+            else:
+                scheduled.setdefault(event_id, [
+                    activity_name, scheduled_event['activity_id'], {}])[2][
+                        activity_id] = failure_count
+
+        return dict(
+            context={
+                key: value for key, value in current.items()
+                if key not in context.EXECUTION_KEYS},
+            workflow_input=self.context.workflow_input,
+            completed=completed,
+            failures=failures,
+            scheduled=scheduled)
+
+    def restore(self, snapshot):
+        """Restore a snapshot of a history (see `snapshot`.)
+
+        Snapshots recorded in markers also carry the id of the last event they
+        include and the attributes of the workflow execution start.
+
+        Args:
+            snapshot (dict): the snapshot.
+        """
+
+        self.context.restore(
+            snapshot.get('context', {}), snapshot.get('workflow_input', {}))
+
+        for activity_name, completed in snapshot.get('completed', {}).items():
+            if completed is True:
+                self.activity_states[activity_name] = CompletedActivityStates()
+                continue
+
+            activity_states = self.activity_states.setdefault(activity_name, {})
+            for activity_id in completed:
+                states = activity.ActivityState(activity_id)
+                states.add_state(activity.ACTIVITY_SCHEDULED)
+                states.add_state(activity.ACTIVITY_COMPLETED)
+                activity_states[activity_id] = states
+
+        for activity_name, failures in snapshot.get('failures', {}).items():
+            activity_states = self.activity_states.setdefault(activity_name, {})
+            for activity_id, count in failures.items():
+                states = activity.ActivityState(activity_id)
+                for failure in range(count):
+                    states.add_state(activity.ACTIVITY_SCHEDULED)
+                    states.add_state(activity.ACTIVITY_FAILED)
+                activity_states[activity_id] = states
+
+        for event_id, scheduled in snapshot.get('scheduled', {}).items():
+            activity_name, activity_id, failures = scheduled
+            scheduled_event = {
+                'activity_name': activity_name,
+                'activity_id': activity_id}
+            if isinstance(failures, dict):
+                scheduled_event.update(members=list(failures))
+            else:
+                failures = {activity_id: failures}
+
+            activity_states = self.activity_states.setdefault(activity_name, {})
+            for instance_id, count in failures.items():
+                states = activity.ActivityState(instance_id)
+                for failure in range(count):
+                    states.add_state(activity.ACTIVITY_SCHEDULED)
+                    states.add_state(activity.ACTIVITY_FAILED)
+                states.add_state(activity.ACTIVITY_SCHEDULED)
+                activity_states[instance_id] = states
+            self.scheduled_events[int(event_id)] = scheduled_event
+
+        if 'last_event_id' in snapshot:
+            self.last_event_id = snapshot['last_event_id']
+            self.snapshot_event_id = self.last_event_id
+        if 'start_attributes' in snapshot:
+            self.start_attributes = snapshot['start_attributes']
+
+    def get_scheduled_states(self, scheduled_event_id):
+        """Get the states of the instances scheduled by an event.
+
+        Args:
+            scheduled_event_id (int): id of the ActivityTaskScheduled event.
+        Return:
+            list: the states of the instances (several for a batch.)
+        """
+
+        scheduled_event = self.scheduled_events.get(scheduled_event_id)
+        activity_states = self.activity_states.setdefault(
+            scheduled_event.get('activity_name'), {})
+        return [
+            activity_states.setdefault(
+                activity_id, activity.ActivityState(activity_id))
+            for activity_id in (
+                scheduled_event.get('members') or
+                [scheduled_event.get('activity_id')])]
+
+    def get_activity_state(self, scheduled_event_id):
+        """Get the state of the activity scheduled by an event.
+
+        Args:
+            scheduled_event_id (int): id of the ActivityTaskScheduled event.
+        Return:
+            ActivityState: the state of the activity.
+        """
+
+        activity_event = self.scheduled_events.get(scheduled_event_id)
+        activity_id = activity_event.get('activity_id')
+        return self.activity_states.setdefault(
+            activity_event.get('activity_name'), {}).setdefault(
+                activity_id, activity.ActivityState(activity_id))
+
+    def workflow_execution_started(self, event):
+        """Set the execution input from the workflow start.
+
+        When the run continues a previous run, its input carries the state of
+        the previous run, which is restored.
+        """
+
+        self.start_attributes = event['workflowExecutionStartedEventAttributes']
+        execution_input = self.start_attributes.get('input') or ''
+
+        if CONTINUED_STATE_KEY in execution_input:
+            continued_state = json.loads(execution_input).get(
+                CONTINUED_STATE_KEY)
+            if continued_state:
+                self.restore(utils.decompress(continued_state))
+                return
+
+        self.context.set_execution_input(event)
+
+    def activity_task_scheduled(self, event):
+        """Record the scheduling of an activity (or of a batch of instances.)
+        """
+
+        activity_info = event.get('activityTaskScheduledEventAttributes')
+        activity_id = activity_info.get('activityId')
+        activity_name = activity_info.get('activityType').get('name')
+        scheduled_event = {
+            'activity_name': activity_name,
+            'activity_id': activity_id}
+
+        control = activity_info.get('control')
+        if control and activity.BATCH_KEY in control:
+            scheduled_event.update(
+                members=json.loads(control).get(activity.BATCH_KEY))
+        self.scheduled_events[event.get('eventId')] = scheduled_event
+
+        for states in self.get_scheduled_states(event.get('eventId')):
+            states.add_state(activity.ACTIVITY_SCHEDULED)
+
+    def activity_task_failed(self, event):
+        """Mark an activity as failed.
+        """
+
+        activity_info = event.get('activityTaskFailedEventAttributes')
+        for states in self.get_scheduled_states(
+                activity_info.get('scheduledEventId')):
+            states.add_state(activity.ACTIVITY_FAILED)
+
+    def activity_task_completed(self, event):
+        """Mark an activity as completed and add its result.
+
+        The result of a batch holds the result of each of its instances.
+        """
+
+        activity_info = event.get('activityTaskCompletedEventAttributes')
+        scheduled_event_id = activity_info.get('scheduledEventId')
+
+        # The result is decoded once and shared by the activity state and
+        # the execution context.
+        result = json.loads(activity_info.get('result') or '{}')
+
+        if 'members' not in self.scheduled_events.get(scheduled_event_id):
+            state = self.get_activity_state(scheduled_event_id)
+            state.add_state(activity.ACTIVITY_COMPLETED)
+            state.set_result(result)
+            self.context.add_result(result)
+            return
+
+        batch_states = self.get_scheduled_states(scheduled_event_id)
+        results = result.get(activity.BATCH_KEY) or {}
+        duration = result.get(activity.BATCH_DURATION_KEY)
+        for states in batch_states:
+            instance_result = results.get(states.activity_id) or {}
+            states.add_state(activity.ACTIVITY_COMPLETED)
+            states.set_result(instance_result)
+            if duration is not None:
+                states.duration = duration / len(batch_states)
+            self.context.add_result(instance_result)
+
+    reducers = {
+        'WorkflowExecutionStarted': workflow_execution_started,
+        'ActivityTaskScheduled': activity_task_scheduled,
+        'ActivityTaskFailed': activity_task_failed,
+        'ActivityTaskCompleted': activity_task_completed,
+    }
+
+
+class CompletedActivityStates(dict):
+
+    def __init__(self):
+        """Create the activity states of an activity that has completed.
+
+        Activities that had completed in a previous run (see
+        `RunHistory.restore`) are only known by their name: the state of any
+        of their instances is completed.
+        """
+
+        states = activity.ActivityState(None)
+        states.add_state(activity.ACTIVITY_SCHEDULED)
+        states.add_state(activity.ACTIVITY_COMPLETED)
+        dict.__init__(self, {None: states})
+        self.states = states
+
+    def get(self, activity_id, default=None):
+        return self.states
+
+
+class HistoryCache:
+
+    def __init__(
+            self, max_runs=DEFAULT_CACHE_MAX_RUNS,
+            max_events=DEFAULT_CACHE_MAX_EVENTS):
+        """Create a history cache.
+
+        The history cache keeps the run histories of the most recently decided
+        workflow runs (keyed by run id), so a decider only has to fold the
+        events that have been added since its last decision. The least
+        recently used runs are evicted when the cache holds more than
+        `max_runs` runs or more than `max_events` folded events. The cache
+        can be shared by several threads.
+
+        Args:
+            max_runs (int): maximum number of runs kept in the cache.
+            max_events (int): maximum number of folded events kept across all
+                the runs of the cache.
+        """
+
+        self.max_runs = max_runs
+        self.max_events = max_events
+        self.runs = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.runs)
+
+    def get(self, run_id):
+        """Get the history of a run.
+
+        Args:
+            run_id (str): the run id.
+        Return:
+            RunHistory: the history of the run (None if not cached.)
+        """
+
+        with self.lock:
+            run_history = self.runs.get(run_id)
+            if run_history is not None:
+                self.runs.move_to_end(run_id)
+            return run_history
+
+    def set(self, run_id, run_history):
+        """Store the history of a run.
+
+        Args:
+            run_id (str): the run id.
+            run_history (RunHistory): the history of the run.
+        """
+
+        with self.lock:
+            self.runs[run_id] = run_history
+            self.runs.move_to_end(run_id)
+            self.evict()
+
+    def pop(self, run_id):
+        """Take the history of a run out of the cache.
+
+        Args:
+            run_id (str): the run id.
+        Return:
+            RunHistory: the history of the run (None if not cached.)
+        """
+
+        with self.lock:
+            return self.runs.pop(run_id, None)
+
+    def remove(self, run_id):
+        """Remove the history of a run (for instance once it is closed.)
+
+        Args:
+            run_id (str): the run id.
+        """
+
+        self.pop(run_id)
+
+    def evict(self):
+        """Evict the least recently used runs until the bounds are met.
+        """
+
+        with self.lock:
+            total_events = sum(
+                run_history.total_events
+                for run_history in self.runs.values())
+
+            while self.runs and (
+                    len(self.runs) > self.max_runs or
+                    total_events > self.max_events):
+                run_id, run_history = self.runs.popitem(last=False)
+                total_events -= run_history.total_events
+
+
+def sort_events(events):
+    """Sort events by id.
+
+    Pages of events are usually already sorted, in which case the events are
+    returned as is.
+
+    Args:
+        events (list): list of events.
+    Return:
+        list: the events sorted by id.
+    """
+
+    previous_id = None
+    for event in events:
+        event_id = event.get('eventId')
+        if previous_id is not None and event_id < previous_id:
+            return sorted(events, key=lambda item: item.get('eventId'))
+        previous_id = event_id
+    return events
+
+
+def find_snapshot(events):
+    """Find the latest snapshot recorded in a list of events.
+
+    Args:
+        events (list): list of events (in any order.)
+    Return:
+        dict: the snapshot (None if no snapshot marker has been found.)
+    """
+
+    markers = [
+        e for e in events
+        if e.get('eventType') == 'MarkerRecorded' and
+        e['markerRecordedEventAttributes'].get('markerName') == (
+            SNAPSHOT_MARKER)]
+
+    if not markers:
+        return None
+
+    marker = max(markers, key=lambda item: item.get('eventId'))
+    return utils.decompress(
+        marker['markerRecordedEventAttributes'].get('details'))
 
 
 def activity_states_from_events(events):
@@ -22,60 +518,9 @@ def activity_states_from_events(events):
         `dict`: the activities and their state.
     """
 
-    events = sorted(events, key=lambda item: item.get('eventId'))
-    event_id_info = dict()
-    activity_events = dict()
-
-    for event in events:
-        event_id = event.get('eventId')
-        event_type = event.get('eventType')
-
-        if event_type == 'ActivityTaskScheduled':
-            activity_info = event.get('activityTaskScheduledEventAttributes')
-            activity_id = activity_info.get('activityId')
-            activity_name = activity_info.get('activityType').get('name')
-            event_id_info.update({
-                event_id: {
-                    'activity_name': activity_name,
-                    'activity_id': activity_id}
-            })
-
-            activity_events.setdefault(
-                activity_name, {}).setdefault(
-                    activity_id,
-                    activity.ActivityState(activity_id)).add_state(
-                        activity.ACTIVITY_SCHEDULED)
-
-        elif event_type == 'ActivityTaskFailed':
-            activity_info = event.get('activityTaskFailedEventAttributes')
-            activity_event = event_id_info.get(
-                activity_info.get('scheduledEventId'))
-            activity_id = activity_event.get('activity_id')
-
-            activity_events.setdefault(
-                activity_event.get('activity_name'), {}).setdefault(
-                    activity_id,
-                    activity.ActivityState(activity_id)).add_state(
-                        activity.ACTIVITY_FAILED)
-
-        elif event_type == 'ActivityTaskCompleted':
-            activity_info = event.get('activityTaskCompletedEventAttributes')
-            activity_event = event_id_info.get(
-                activity_info.get('scheduledEventId'))
-            activity_id = activity_event.get('activity_id')
-
-            activity_events.setdefault(
-                activity_event.get('activity_name'), {}).setdefault(
-                    activity_id,
-                    activity.ActivityState(activity_id)).add_state(
-                        activity.ACTIVITY_COMPLETED)
-
-            result = json.loads(activity_info.get('result') or '{}')
-            activity_events.get(
-                activity_event.get('activity_name')).get(
-                    activity_id).set_result(result)
-
-    return activity_events
+    run_history = RunHistory()
+    run_history.add_events(events)
+    return run_history.activity_states
 
 
 def get_current_context(events):
@@ -90,6 +535,6 @@ def get_current_context(events):
         dict: The current context.
     """
 
-    events = sorted(events, key=lambda item: item.get('eventId'))
-    execution_context = context.ExecutionContext(events)
-    return execution_context
+    run_history = RunHistory()
+    run_history.add_events(events)
+    return run_history.context
@@ -7,9 +7,11 @@ or in parallel). There's only one task runner per activity.
 """
 
 from concurrent import futures
+import collections
 from concurrent.futures import ThreadPoolExecutor
 
 from garcon.task import flatten
+from garcon.task import is_task_list
 
 
 DEFAULT_TASK_TIMEOUT = 600   # 10 minutes.
@@ -29,6 +31,66 @@ class BaseRunner():
     def __init__(self, *args):
         self.tasks = args
 
+    def describe(self, context):
+        """Describe the tasks of the runner for a given context.
+
+        The tasks are flattened once to calculate the timeout, the heartbeat
+        and the requirements of the activity. When none of the tasks is a task
+        list, the description does not depend on the context and is only
+        calculated once for the runner.
+
+        Args:
+            context (dict): the context.
+        Return:
+            dict: the timeout, the heartbeat and the requirements (None if at
+                least one task does not define its requirements.)
+        """
+
+        description = getattr(self, '_description', None)
+        if description and description[0] is self.tasks:
+            return description[1]
+
+        timeout = 0
+        heartbeat = 0
+        requirements = set()
+        is_static = True
+
+        # The task lists themselves are also considered for the requirements
+        # (so the .fill on lists are also taken into account.)
+        for current_task in self.tasks:
+            if is_task_list(current_task):
+                is_static = False
+                subtasks = [current_task] + list(current_task(context))
+            else:
+                subtasks = [current_task]
+
+            for subtask in subtasks:
+                task_details = getattr(subtask, '__garcon__', None)
+                if requirements is not None:
+                    if task_details:
+                        requirements.update(
+                            task_details.get('requirements', []))
+                    else:
+                        requirements = None
+
+                if subtask is current_task and is_task_list(subtask):
+                    continue
+
+                task_details = task_details or dict()
+                timeout += task_details.get('timeout', DEFAULT_TASK_TIMEOUT)
+                heartbeat = max(
+                    heartbeat,
+                    task_details.get('heartbeat', DEFAULT_TASK_HEARTBEAT))
+
+        description = dict(
+            timeout=timeout,
+            heartbeat=heartbeat,
+            requirements=requirements)
+
+        if is_static:
+            self._description = (self.tasks, description)
+        return description
+
     def timeout(self, context):
         """Calculate and return the timeout for an activity.
 
@@ -41,19 +103,7 @@ class BaseRunner():
                 a regular number.)
         """
 
-        timeout = 0
-
-        for task in flatten(self.tasks, context):
-            task_timeout = DEFAULT_TASK_TIMEOUT
-            task_details = getattr(task, '__garcon__', None)
-
-            if task_details:
-                task_timeout = task_details.get(
-                    'timeout', DEFAULT_TASK_TIMEOUT)
-
-            timeout = timeout + task_timeout
-
-        return timeout
+        return self.describe(context).get('timeout')
 
     def heartbeat(self, context):
         """Calculate and return the heartbeat for an activity.
@@ -70,20 +120,28 @@ class BaseRunner():
                 string not a regular number.)
         """
 
-        heartbeat = 0
+        return self.describe(context).get('heartbeat')
 
-        for task in flatten(self.tasks, context):
-            task_details = getattr(task, '__garcon__', None)
-            task_heartbeat = DEFAULT_TASK_HEARTBEAT
+    def resources(self):
+        """Find the resources the tasks need to run.
 
-            if task_details:
-                task_heartbeat = task_details.get(
-                    'heartbeat', DEFAULT_TASK_HEARTBEAT)
+        The resources are declared on the tasks with `task.decorate`. Tasks
+        run one after the other need the largest amount of each resource.
+        Only the tasks known before the activity runs are considered: the
+        tasks generated by a task list need to be declared on the list
+        itself.
 
-            if task_heartbeat > heartbeat:
-                heartbeat = task_heartbeat
+        Return:
+            dict: the amount of each resource.
+        """
 
-        return heartbeat
+        resources = dict()
+        for current_task in self.tasks:
+            task_resources = getattr(
+                current_task, '__garcon__', {}).get('resources') or {}
+            for name, amount in task_resources.items():
+                resources[name] = max(resources.get(name, 0), amount)
+        return resources
 
     def requirements(self, context):
         """Find all the requirements from the list of tasks and return it.
@@ -100,18 +158,10 @@ class BaseRunner():
             set: the list of the required values from the context.
         """
 
-        requirements = []
-
-        # Get all the tasks and the lists (so the .fill on lists are also
-        # considered.)
-        all_tasks = list(self.tasks) + list(flatten(self.tasks, context))
-        for task in all_tasks:
-            task_details = getattr(task, '__garcon__', None)
-            if task_details:
-                requirements += task_details.get('requirements', [])
-            else:
-                raise NoRunnerRequirementsFound()
-        return set(requirements)
+        requirements = self.describe(context).get('requirements')
+        if requirements is None:
+            raise NoRunnerRequirementsFound()
+        return requirements
 
     def execute(self, activity, context):
         """Execution of the tasks.
@@ -126,7 +176,9 @@ class Sync(BaseRunner):
         result = dict()
         for task in flatten(self.tasks, context):
             activity.heartbeat()
-            task_context = dict(list(result.items()) + list(context.items()))
+            # Each task gets its own layer on top of the context and the
+            # results of the previous tasks (nothing is copied.)
+            task_context = collections.ChainMap(dict(), context, result)
             resp = task(task_context, activity=activity)
             result.update(resp or dict())
         return result
@@ -152,6 +204,28 @@ class Async(BaseRunner):
         return result
 
 
+    def resources(self):
+        """Find the resources the tasks need to run.
+
+        Up to `max_workers` tasks run at the same time: the resources are
+        the sum of the resources of the most demanding tasks.
+
+        Return:
+            dict: the amount of each resource.
+        """
+
+        amounts = collections.defaultdict(list)
+        for current_task in self.tasks:
+            task_resources = getattr(
+                current_task, '__garcon__', {}).get('resources') or {}
+            for name, amount in task_resources.items():
+                amounts[name].append(amount)
+
+        return {
+            name: sum(sorted(values, reverse=True)[:self.max_workers])
+            for name, values in amounts.items()}
+
+
 class External(BaseRunner):
 
     def __init__(self, timeout=None, heartbeat=None):
@@ -167,3 +241,21 @@ class External(BaseRunner):
 
         self.timeout = lambda ctx=None: timeout
         self.heartbeat = lambda ctx=None: (heartbeat or timeout)
+
+    def describe(self, context=None):
+        """Describe the external activity.
+
+        External activities do not have tasks: the timeouts are the ones
+        provided and no requirements can be found (the activity receives the
+        full context.)
+
+        Args:
+            context (dict): the context (not used.)
+        Return:
+            dict: the timeout, the heartbeat and the requirements.
+        """
+
+        return dict(
+            timeout=self.timeout(),
+            heartbeat=self.heartbeat(),
+            requirements=None)
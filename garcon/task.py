@@ -23,13 +23,16 @@ from functools import update_wrapper
 from garcon import param
 
 
-def decorate(timeout=None, heartbeat=None, enable_contextify=True):
+def decorate(
+        timeout=None, heartbeat=None, enable_contextify=True, resources=None):
     """Generic task decorator for tasks.
 
     Args:
         timeout (int): The timeout of the task (see timeout).
         heartbeat (int): The heartbeat timeout.
         contextify (boolean): If the task can be contextified (see contextify).
+        resources (dict): The resources the task needs to run, for instance:
+            `{'cpu': 1, 'memory_mb': 512}` (see `ActivityWorker`.)
     Return:
         callable: The wrapper.
     """
@@ -38,6 +41,9 @@ def decorate(timeout=None, heartbeat=None, enable_contextify=True):
         if timeout:
             _decorate(fn, 'timeout', timeout)
 
+        if resources:
+            _decorate(fn, 'resources', dict(resources))
+
         # If the task does not have a heartbeat, but instead the task has
         # a timeout, the heartbeat should be adjusted to the timeout. In
         # most case, most people will probably opt for this option.
@@ -4,7 +4,17 @@ Utils
 
 """
 
+from collections import abc
+import base64
 import hashlib
+import json
+import zlib
+
+
+CANONICAL_KEY_DIGEST_SIZE = 16
+
+canonical_encoder = json.JSONEncoder(
+    sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
 
 
 def create_dictionary_key(dictionary):
@@ -16,7 +26,7 @@ def create_dictionary_key(dictionary):
         str: the key that represents the content of the dictionary.
     """
 
-    if not isinstance(dictionary, dict):
+    if not isinstance(dictionary, abc.Mapping):
         raise TypeError('The value passed should be a dictionary.')
 
     if not dictionary:
@@ -30,6 +40,79 @@ def create_dictionary_key(dictionary):
 
     return hashlib.sha1(key_parts.encode('utf-8')).hexdigest()
 
+
+def create_canonical_key(dictionary):
+    """Create a canonical key that represents the content of the dictionary.
+
+    The dictionary is encoded in canonical json (sorted keys at all levels,
+    unicode kept as is), which is stable for nested values, and hashed with
+    blake2b into a short digest.
+
+    Args:
+        dictionary (dict): the dictionary to use.
+    Return:
+        str: the key that represents the content of the dictionary.
+    """
+
+    return create_canonical_keys([dictionary])[0]
+
+
+def create_canonical_keys(dictionaries):
+    """Create the canonical keys of a list of dictionaries in one pass.
+
+    Args:
+        dictionaries (iterable): the dictionaries to use.
+    Return:
+        list: the keys (see `create_canonical_key`), in the same order.
+    """
+
+    encode = canonical_encoder.encode
+    blake2b = hashlib.blake2b
+    keys = []
+
+    for dictionary in dictionaries:
+        if not isinstance(dictionary, abc.Mapping):
+            raise TypeError('The value passed should be a dictionary.')
+
+        if not dictionary:
+            raise ValueError('The dictionary cannot be empty.')
+
+        if not isinstance(dictionary, dict):
+            dictionary = dict(dictionary)
+
+        keys.append(blake2b(
+            encode(dictionary).encode('utf-8'),
+            digest_size=CANONICAL_KEY_DIGEST_SIZE).hexdigest())
+    return keys
+
+
+def compress(value):
+    """Compress a json serializable value into a string.
+
+    The value is encoded in compact json, compressed with zlib and encoded in
+    base64 (so it can be sent in any SWF string field: input, details...)
+
+    Args:
+        value (object): the value to compress.
+    Return:
+        str: the compressed value.
+    """
+
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return base64.b64encode(zlib.compress(data)).decode('ascii')
+
+
+def decompress(data):
+    """Decompress a value compressed with `compress`.
+
+    Args:
+        data (str): the compressed value.
+    Return:
+        object: the value.
+    """
+
+    return json.loads(zlib.decompress(base64.b64decode(data)).decode('utf-8'))
+
 def non_throttle_error(exception):
     """Activity Runner.
 
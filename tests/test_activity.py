@@ -1,12 +1,15 @@
 from unittest.mock import MagicMock
 from unittest.mock import ANY
+import itertools
 import json
 import sys
+import threading
 
 from botocore import exceptions
 import pytest
 
 from garcon import activity
+from garcon import context
 from garcon import event
 from garcon import runner
 from garcon import task
@@ -769,3 +772,686 @@ def test_activity_state():
         state.set_result('shouldnt reset')
 
     assert state.result == result
+
+
+def test_compiled_flow_layers():
+    """Test the activities of a compiled flow are ordered in layers.
+    """
+
+    from tests.fixtures.flows import example
+
+    compiled_flow = activity.CompiledFlow(example)
+    assert len(compiled_flow.activities) == 4
+    assert compiled_flow.layers == [
+        [example.activity_1],
+        [example.activity_2, example.activity_3],
+        [example.activity_4]]
+
+    assert activity.compile_flow(compiled_flow) is compiled_flow
+    assert activity.find_workflow_activities(compiled_flow) is (
+        compiled_flow.activities)
+
+
+def test_compiled_flow_with_cycle(boto_client):
+    """Test a flow with a requirement cycle cannot be compiled.
+    """
+
+    class Flow:
+        pass
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    flow = Flow()
+    flow.activity_1 = create(name='activity_1')
+    flow.activity_2 = create(name='activity_2', requires=[flow.activity_1])
+    flow.activity_1.requires = [flow.activity_2]
+
+    with pytest.raises(activity.CyclicRequirementsException):
+        activity.CompiledFlow(flow)
+
+
+def test_compiled_flow_frontier():
+    """Test the frontier only contains activities with completed requirements.
+    """
+
+    from tests.fixtures.flows import example
+
+    compiled_flow = activity.CompiledFlow(example)
+    events = decider.history['events']
+
+    history = event.activity_states_from_events(events[:1])
+    assert list(compiled_flow.frontier(history)) == [example.activity_1]
+
+    history = event.activity_states_from_events(events[:7])
+    assert list(compiled_flow.frontier(history)) == [
+        example.activity_1, example.activity_2, example.activity_3]
+
+    history = event.activity_states_from_events(events[:25])
+    assert list(compiled_flow.frontier(history)) == [
+        example.activity_1, example.activity_2, example.activity_3,
+        example.activity_4]
+
+
+def test_find_available_activities_skips_unready_generators():
+    """Test generators of activities outside of the frontier are not run.
+    """
+
+    from tests.fixtures.flows import example
+
+    spy = MagicMock(return_value=[])
+    compiled_flow = activity.CompiledFlow(example)
+    history = event.activity_states_from_events(decider.history['events'][:1])
+
+    example.activity_4.generators = [spy]
+    try:
+        list(activity.find_available_activities(compiled_flow, history, {}))
+    finally:
+        example.activity_4.generators = []
+
+    assert not spy.called
+
+
+def test_instance_cache(boto_client):
+    """Test the instances of an activity are memoized per fingerprint.
+    """
+
+    from tests.fixtures.flows import example
+
+    def generator(context):
+        for i in range(5):
+            yield {'i': i}
+
+    spy = MagicMock(side_effect=generator)
+    compiled_flow = activity.CompiledFlow(example)
+    history = event.activity_states_from_events(decider.history['events'][:1])
+    current_context = context.ExecutionContext()
+    instance_cache = activity.InstanceCache(current_context.fingerprint)
+
+    example.activity_1.generators = [spy]
+    try:
+        available = list(activity.find_available_activities(
+            compiled_flow, history, current_context.current,
+            instance_cache=instance_cache))
+        uncomplete = list(activity.find_uncomplete_activities(
+            compiled_flow, history, current_context.current,
+            instance_cache=instance_cache))
+    finally:
+        example.activity_1.generators = []
+
+    assert spy.call_count == 1
+    assert len(available) == 5
+    assert len(uncomplete) == 8
+    assert all(instance.pool_size == 5 for instance in available)
+
+
+def test_instance_pool_size(boto_client):
+    """Test the schedule to start timeout uses the pool size of the instance.
+    """
+
+    current_activity = activity.Activity(boto_client)
+    current_activity.hydrate(dict(schedule_to_start=10))
+    current_activity.generators = [
+        lambda context: [{'i': i} for i in range(3)]]
+
+    instances = list(current_activity.instances({}))
+    current_activity.generators = []
+    list(current_activity.instances({}))
+
+    assert current_activity.pool_size == 1
+    assert instances[0].schedule_to_start == 30
+
+
+def test_activity_instance_description(boto_client):
+    """Test the runner description is calculated once per instance.
+    """
+
+    @task.decorate(timeout=10)
+    def task_a(value):
+        pass
+
+    spy = MagicMock()
+
+    @task.list
+    def task_list(context):
+        spy()
+        yield task_a.fill(value='value')
+
+    current_activity = activity.Activity(boto_client)
+    current_activity.hydrate(dict(schedule_to_start=10))
+    current_activity.runner = runner.Sync(task_list)
+    instance = list(current_activity.instances(dict(value=1)))[0]
+
+    assert instance.timeout == 10
+    assert instance.schedule_to_close == 20
+    assert instance.heartbeat_timeout == 10
+    assert instance.create_execution_input().get('value') == 1
+    assert spy.call_count == 1
+
+    with pytest.raises(AttributeError):
+        instance.custom_attribute = True
+
+
+def test_activity_instance_global_context():
+    """Test the global context layers the local and execution contexts.
+    """
+
+    activity_mock = MagicMock()
+    activity_mock.runner = runner.BaseRunner(lambda context: None)
+    execution_context = dict(foo='execution', bar='execution')
+    instance = activity.ActivityInstance(
+        activity_mock, local_context=dict(foo='local'),
+        execution_context=execution_context)
+
+    assert instance.global_context['foo'] == 'local'
+    assert instance.global_context['bar'] == 'execution'
+
+    execution_context.update(baz='execution')
+    assert instance.global_context['baz'] == 'execution'
+
+    resp = instance.create_execution_input()
+    assert isinstance(resp, dict)
+    assert json.loads(json.dumps(resp)) == dict(
+        foo='local', bar='execution', baz='execution')
+
+
+def test_create_activity_instance_id_is_cached(monkeypatch):
+    """Test the id of an instance is only calculated once.
+    """
+
+    monkeypatch.setattr(
+        utils, 'create_dictionary_key', MagicMock(return_value='key'))
+
+    activity_mock = MagicMock()
+    activity_mock.name = 'activity'
+    instance = activity.ActivityInstance(activity_mock, dict(foobar='yes'))
+
+    assert instance.id == 'activity-key'
+    assert instance.id == 'activity-key'
+    assert utils.create_dictionary_key.call_count == 1
+
+
+def test_instances_with_canonical_ids(boto_client):
+    """Test the instances of an activity with canonical ids.
+    """
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(
+        name='activity',
+        canonical_ids=True,
+        generators=[lambda context: [{'i': i} for i in range(3)] + [{}]])
+    assert current_activity.canonical_ids
+
+    instances = list(current_activity.instances({}))
+    assert len(set(instance.id for instance in instances)) == 4
+    assert instances[-1].id == 'flow_activity-1'
+
+    for instance in instances[:-1]:
+        assert instance.id == '{}-{}'.format(
+            current_activity.name,
+            utils.create_canonical_key(instance.local_context))
+
+        # The ids match the ones calculated by the instance itself.
+        standalone = activity.ActivityInstance(
+            current_activity, local_context=instance.local_context)
+        assert standalone.id == instance.id
+
+
+def test_find_available_activities_with_max_in_flight(boto_client):
+    """Test at most `max_in_flight` instances of an activity are in flight.
+    """
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(
+        name='activity',
+        generators=[lambda context: [{'i': i} for i in range(5)]],
+        run=runner.Sync(lambda context, activity: None),
+        max_in_flight=2)
+    flow = MagicMock(spec=[])
+    flow.activity = current_activity
+    compiled_flow = activity.CompiledFlow(flow)
+
+    available = list(
+        activity.find_available_activities(compiled_flow, {}, {}))
+    assert len(available) == 2
+    assert all(instance.pool_size == 2 for instance in available)
+    assert available[0].schedule_to_start == (
+        2 * current_activity.schedule_to_start_timeout)
+
+    history = {current_activity.name: {}}
+    for instance, last_state in zip(
+            available, [activity.ACTIVITY_COMPLETED, None]):
+        states = activity.ActivityState(instance.id)
+        states.add_state(activity.ACTIVITY_SCHEDULED)
+        if last_state:
+            states.add_state(last_state)
+        history[current_activity.name][instance.id] = states
+
+    refill = list(
+        activity.find_available_activities(compiled_flow, history, {}))
+    assert len(refill) == 1
+    assert refill[0].id not in [instance.id for instance in available]
+    assert activity.count_in_flight(history[current_activity.name]) == 1
+
+    states = activity.ActivityState(refill[0].id)
+    states.add_state(activity.ACTIVITY_SCHEDULED)
+    history[current_activity.name][refill[0].id] = states
+    assert not list(
+        activity.find_available_activities(compiled_flow, history, {}))
+
+
+def test_execute_batch(monkeypatch, boto_client):
+    """Test the instances of a batch are executed one after the other.
+    """
+
+    monkeypatch.setattr(
+        activity.ActivityExecution, 'heartbeat', lambda self: None)
+
+    def double(context, activity=None):
+        return {'double.{}'.format(context['i']): context['i'] * 2}
+
+    current_activity = activity.Activity(boto_client)
+    current_activity.runner = runner.Sync(double)
+    execution = activity.ActivityExecution(
+        boto_client, 'activityId', 'taskToken', json.dumps({
+            'shared': 'value',
+            activity.BATCH_KEY: [['a-1', {'i': 1}], ['a-2', {'i': 2}]]}))
+
+    result = current_activity.execute_activity(execution)
+    assert result[activity.BATCH_KEY] == {
+        'a-1': {'double.1': 2}, 'a-2': {'double.2': 4}}
+    assert result[activity.BATCH_DURATION_KEY] >= 0
+
+
+def test_get_batch_size(boto_client):
+    """Test the size of the batches adapts to the observed durations.
+    """
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    assert activity.get_batch_size(create(name='unbatched'), {}) == 1
+
+    current_activity = create(name='activity', batch_size=10)
+    assert activity.get_batch_size(current_activity, {}) == 10
+
+    current_activity = create(
+        name='adaptive', batch_size=10, batch_duration=1)
+    assert activity.get_batch_size(current_activity, {}) == 10
+
+    activity_states = dict()
+    for index, duration in enumerate([0.2, 0.3, None]):
+        states = activity.ActivityState(str(index))
+        states.duration = duration
+        activity_states[str(index)] = states
+    assert activity.get_batch_size(current_activity, activity_states) == 4
+
+    activity_states['0'].duration = activity_states['1'].duration = 5
+    assert activity.get_batch_size(current_activity, activity_states) == 1
+
+    activity_states['0'].duration = activity_states['1'].duration = 0.01
+    assert activity.get_batch_size(current_activity, activity_states) == 10
+
+
+def test_instances_order(boto_client):
+    """Test the instances are ordered by their scheduling hints.
+    """
+
+    costs = [3, 10, None, 7]
+
+    def generator(context):
+        for index, cost in enumerate(costs):
+            yield {
+                'index': index,
+                activity.COST_KEY: cost,
+                activity.PRIORITY_KEY: index}
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    fifo = create(name='fifo', generators=[generator], priority=5)
+    instances = list(fifo.instances({}))
+    assert [instance.local_context for instance in instances] == [
+        {'index': index} for index in range(4)]
+    assert [instance.cost for instance in instances] == costs
+    assert [instance.priority for instance in instances] == list(range(4))
+
+    lpt = create(name='lpt', generators=[generator], order=activity.ORDER_LPT)
+    assert [
+        instance.local_context['index']
+        for instance in lpt.instances({})] == [1, 3, 0, 2]
+
+    custom = create(
+        name='custom', generators=[generator],
+        order=lambda instance: -instance.local_context['index'])
+    assert [
+        instance.local_context['index']
+        for instance in custom.instances({})] == [3, 2, 1, 0]
+
+    # The priority of the activity is the default one.
+    single = create(name='single', priority=5)
+    assert list(single.instances({}))[0].priority == 5
+
+    with pytest.raises(ValueError):
+        create(name='unknown', order='random')
+
+
+def test_instances_are_streamed(boto_client):
+    """Test the instances are created as they are consumed.
+    """
+
+    consumed = []
+
+    @activity.length_hint(lambda context: context['size'])
+    def first(context):
+        for i in range(context['size']):
+            consumed.append(i)
+            yield {'i': i}
+
+    def second(context):
+        return [{'j': j} for j in range(1000)]
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(name='activity', generators=[first, second])
+
+    instances = current_activity.instances({'size': 1000})
+    assert [
+        instance.local_context
+        for instance in itertools.islice(instances, 2)] == [
+            {'i': 0, 'j': 0}, {'i': 0, 'j': 1}]
+    assert current_activity.pool_size == 1000000
+    assert consumed == [0]
+
+    # Without a length hint, the values of the first generator are consumed
+    # to calculate the pool size.
+    current_activity.generators = [
+        lambda context: ({'i': i} for i in range(3)), second]
+    next(current_activity.instances({}))
+    assert current_activity.pool_size == 3000
+
+
+def test_stream_product():
+    """Test the streamed product matches the cartesian product.
+    """
+
+    values = [[{'a': 1}, {'a': 2}], [{'b': 1}], [{'c': 1}, {'c': 2}]]
+    size, product = activity.stream_product(
+        [(iter(value), len(value)) for value in values], {})
+    assert size == 4
+    assert list(product) == list(itertools.product(*values))
+
+    size, product = activity.stream_product([([], None)], {})
+    assert size == 0
+    assert not list(product)
+
+
+def test_instance_cache_is_lazy(monkeypatch, boto_client):
+    """Test the cached instances are only created when consumed.
+    """
+
+    monkeypatch.setattr(activity, 'INSTANCES_CHUNK_SIZE', 2)
+    consumed = []
+
+    @activity.length_hint(5)
+    def generator(context):
+        for i in range(5):
+            consumed.append(i)
+            yield {'i': i}
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(name='activity', generators=[generator])
+
+    instance_cache = activity.InstanceCache(None)
+    instances = instance_cache.get(current_activity, {})
+    first = next(iter(instances))
+    assert consumed == [0, 1]
+    assert list(instances)[0] is first
+    assert len(list(instances)) == 5
+    assert instance_cache.get(current_activity, {}) is instances
+    assert consumed == list(range(5))
+
+
+class FakeArray(list):
+    """List that converts its values like a NumPy array.
+    """
+
+    def __getitem__(self, index):
+        return FakeScalar(list.__getitem__(self, index))
+
+
+class FakeScalar:
+
+    def __init__(self, value):
+        self.value = value
+
+    def tolist(self):
+        return self.value
+
+
+@pytest.mark.parametrize('canonical_ids', [False, True])
+def test_instances_from_columns(boto_client, canonical_ids):
+    """Test the instances created from columnar generator values.
+    """
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    rows = create(
+        name='activity', canonical_ids=canonical_ids,
+        generators=[lambda context: [
+            {'i': i, 'name': str(i)} for i in range(3)]])
+    columns = create(
+        name='activity', canonical_ids=canonical_ids,
+        generators=[lambda context: {
+            'i': FakeArray(range(3)),
+            'name': ['0', '1', '2'],
+            activity.PRIORITY_KEY: [None, 5, 1]}])
+
+    instances = list(columns.instances({}))
+    assert columns.pool_size == 3
+    assert isinstance(instances[0].local_context, activity.ColumnRow)
+    assert [instance.id for instance in instances] == [
+        instance.id for instance in rows.instances({})]
+    assert dict(instances[1].local_context) == {'i': 1, 'name': '1'}
+    assert [instance.priority for instance in instances] == [None, 5, 1]
+
+    # Rows merged with the values of another generator.
+    columns.generators.append(lambda context: [{'j': 1}, {'j': 2}])
+    instances = list(columns.instances({}))
+    assert len(instances) == 6
+    assert instances[3].local_context == {'i': 1, 'name': '1', 'j': 2}
+    assert instances[3].priority == 5
+
+    with pytest.raises(ValueError):
+        activity.Columns({'i': [1, 2], 'j': [1]})
+
+
+def test_concurrent_worker_runner():
+    """Test the tasks of an activity are executed concurrently.
+    """
+
+    stop = threading.Event()
+    barrier = threading.Barrier(3, timeout=5)
+    processed = []
+    broken = []
+    executions = iter([MagicMock(activity_id=str(i)) for i in range(6)])
+    lock = threading.Lock()
+
+    worker = MagicMock()
+
+    def poll():
+        with lock:
+            return next(executions, None)
+
+    def process(execution):
+        # The first three tasks are only released once they all run.
+        if int(execution.activity_id) < 3:
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                broken.append(execution.activity_id)
+        with lock:
+            processed.append(execution.activity_id)
+            if len(processed) == 6:
+                stop.set()
+
+    worker.poll.side_effect = poll
+    worker.process.side_effect = process
+    activity.concurrent_worker_runner(worker, 2, 3, stop=stop)
+
+    assert sorted(processed) == [str(i) for i in range(6)]
+    assert not broken
+
+
+def test_worker_run_with_pollers(monkeypatch, boto_client):
+    """Test the pollers and the concurrency of the activities.
+    """
+
+    from tests.fixtures.flows import example
+
+    concurrent_runner = MagicMock()
+    runner = MagicMock()
+    monkeypatch.setattr(
+        activity, 'concurrent_worker_runner', concurrent_runner)
+    monkeypatch.setattr(activity, 'worker_runner', runner)
+    monkeypatch.setattr(example.activity_1, 'concurrency', 4)
+
+    activity.ActivityWorker(example).run()
+    concurrent_runner.assert_called_once_with(
+        example.activity_1, 1, 4, None, 0)
+    assert runner.call_count == 3
+
+    concurrent_runner.reset_mock()
+    activity.ActivityWorker(
+        example, activities=[example.activity_2.name], pollers=2).run()
+    concurrent_runner.assert_called_once_with(
+        example.activity_2, 2, 2, None, 0)
+
+
+def test_capacity():
+    """Test the resources reserved in a capacity.
+    """
+
+    capacity = activity.Capacity(dict(cpu=4, memory_mb=1024))
+    capacity.acquire(dict(cpu=3, memory_mb=512, token=1))
+    assert capacity.fits(dict(cpu=1, memory_mb=512))
+    assert not capacity.fits(dict(cpu=2))
+    assert capacity.fits(dict(token=10))
+
+    acquired = threading.Event()
+
+    def acquire():
+        capacity.acquire(dict(cpu=2))
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.05)
+    capacity.release(dict(cpu=3, memory_mb=512, token=1))
+    assert acquired.wait(5)
+    thread.join()
+    assert capacity.used == dict(cpu=2, memory_mb=0)
+
+    # A need larger than the capacity is admitted when the resource is free.
+    capacity.release(dict(cpu=2))
+    assert capacity.fits(dict(cpu=8))
+
+
+def test_concurrent_worker_runner_with_capacity(boto_client):
+    """Test an activity only polls when its resources are available.
+    """
+
+    @task.decorate(resources=dict(memory_mb=600))
+    def heavy(context):
+        pass
+
+    capacity = activity.Capacity(dict(memory_mb=1000))
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(name='activity', run=runner.Sync(heavy))
+
+    stop = threading.Event()
+    polls = []
+    executions = []
+
+    def poll(identity=None):
+        polls.append(dict(capacity.used))
+        if len(polls) == 3:
+            stop.set()
+        return MagicMock(activity_id=str(len(polls)))
+
+    def process(execution):
+        executions.append(dict(capacity.used))
+
+    current_activity.poll = poll
+    current_activity.process = process
+    activity.concurrent_worker_runner(
+        current_activity, 2, 2, capacity=capacity, stop=stop)
+
+    # Two tasks do not fit: a single task is reserved at any time, and the
+    # resources are released once it is executed.
+    assert len(polls) >= 3
+    assert all(used == dict(memory_mb=600) for used in polls + executions)
+    assert capacity.used == dict(memory_mb=0)
+
+
+def test_prefetched_tasks_heartbeat(monkeypatch, boto_client):
+    """Test the prefetched tasks are heartbeated while they wait.
+    """
+
+    @task.decorate(timeout=60, heartbeat=10)
+    def short(context):
+        pass
+
+    now = [100]
+    monkeypatch.setattr(activity.time, 'monotonic', lambda: now[0])
+    create = activity.create(boto_client, 'domain', 'flow')
+    prefetched = activity.PrefetchedTasks(
+        create(name='activity', run=runner.Sync(short)))
+
+    waiting = MagicMock(context={})
+    started = MagicMock(context={})
+    prefetched.add(waiting)
+    prefetched.add(started)
+    prefetched.remove(started)
+
+    prefetched.heartbeat()
+    assert not waiting.heartbeat.called
+
+    now[0] = 105
+    prefetched.heartbeat()
+    prefetched.heartbeat()
+    assert waiting.heartbeat.call_count == 1
+    assert not started.heartbeat.called
+
+    # A failing heartbeat does not stop the others.
+    waiting.heartbeat.side_effect = Exception('timed out')
+    now[0] = 110
+    prefetched.heartbeat()
+    assert waiting.heartbeat.call_count == 2
+
+
+def test_concurrent_worker_runner_with_prefetch():
+    """Test a task is polled while the current one runs.
+    """
+
+    stop = threading.Event()
+    running = threading.Event()
+    polled = threading.Event()
+    events = []
+
+    worker = MagicMock()
+    worker.runner.heartbeat.return_value = 600
+
+    def poll():
+        if stop.is_set():
+            return None
+        events.append('poll')
+        if len(events) == 2:
+            polled.set()
+        return MagicMock(activity_id=str(len(events)), context={})
+
+    def process(execution):
+        events.append('process {}'.format(execution.activity_id))
+        if execution.activity_id == '1':
+            # The next task is polled while this one runs.
+            assert polled.wait(5)
+            stop.set()
+
+    worker.poll.side_effect = poll
+    worker.process.side_effect = process
+    activity.concurrent_worker_runner(worker, 1, 1, prefetch=1, stop=stop)
+
+    assert events[:3] == ['poll', 'process 1', 'poll']
+    assert 'process 2' in events
@@ -0,0 +1,187 @@
+from unittest.mock import MagicMock
+import asyncio
+import json
+
+import pytest
+
+from garcon import activity
+from garcon import aio
+from garcon import decider
+from garcon import event
+from garcon import runner
+from tests.fixtures import decider as decider_events
+
+
+def create_activity(boto_client, *tasks):
+    """Create an activity running the tasks.
+    """
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    return create(name='activity', tasks=runner.Sync(*tasks))
+
+
+def test_run_activity(boto_client):
+    """Test an activity task is polled, executed and completed.
+    """
+
+    client = aio.MemoryClient()
+    task = MagicMock(return_value=dict(result='value'))
+    current_activity = create_activity(boto_client, task)
+    token = client.add_activity_task(
+        current_activity.task_list, 'activity-1', dict(key='value'))
+
+    assert asyncio.run(aio.run_activity(current_activity, client, 'worker'))
+    assert task.call_args[0][0]['key'] == 'value'
+    assert client.completed == [
+        dict(taskToken=token, result=json.dumps(dict(result='value')))]
+
+    # The heartbeats of the task (made in a thread) go through the loop.
+    assert client.heartbeats == [dict(taskToken=token, details='')]
+    assert not boto_client.record_activity_task_heartbeat.called
+
+
+def test_run_activity_fail(boto_client):
+    """Test a failing activity task is reported.
+    """
+
+    client = aio.MemoryClient()
+    error = Exception('fail')
+    current_activity = create_activity(
+        boto_client, MagicMock(side_effect=error))
+    current_activity.on_exception = MagicMock()
+    token = client.add_activity_task(current_activity.task_list, 'activity-1')
+
+    assert asyncio.run(aio.run_activity(current_activity, client))
+    assert client.failed == [dict(taskToken=token, reason='fail')]
+    assert not client.completed
+    current_activity.on_exception.assert_called_with(current_activity, error)
+
+
+def test_run_activity_empty_poll(boto_client):
+    """Test an empty poll is not executed.
+    """
+
+    client = aio.MemoryClient(poll_timeout=0)
+    task = MagicMock()
+    current_activity = create_activity(boto_client, task)
+
+    assert asyncio.run(aio.run_activity(current_activity, client))
+    assert not task.called
+    assert not client.completed
+
+
+def test_run_activity_poll_exception(boto_client):
+    """Test the poll errors are reported and the loop keeps running.
+    """
+
+    error = Exception('poll')
+    client = aio.MemoryClient()
+    client.poll_for_activity_task = MagicMock(side_effect=error)
+    current_activity = create_activity(boto_client, MagicMock())
+    current_activity.on_exception = MagicMock()
+
+    assert asyncio.run(aio.run_activity(current_activity, client))
+    current_activity.on_exception.assert_called_with(current_activity, error)
+
+
+def test_run_activities_concurrently(boto_client):
+    """Test the polls of an activity are concurrent.
+    """
+
+    client = aio.MemoryClient(poll_timeout=1)
+    current_activity = create_activity(
+        boto_client, MagicMock(return_value=dict()))
+
+    async def run():
+        polls = [
+            asyncio.ensure_future(aio.run_activity(current_activity, client))
+            for poll in range(3)]
+        await asyncio.sleep(0)
+        for index in range(3):
+            client.add_activity_task(
+                current_activity.task_list, 'activity-{}'.format(index))
+        return await asyncio.gather(*polls)
+
+    assert asyncio.run(run()) == [True] * 3
+    assert len(client.completed) == 3
+
+
+@pytest.mark.parametrize('history_cache', [None, event.HistoryCache()])
+def test_run_decider(monkeypatch, history_cache):
+    """Test the decisions made by the async decider, on paged events.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    monkeypatch.setattr(decider, 'MAXIMUM_PAGE_SIZE', 5)
+
+    expected = decider.DeciderWorker(example, register=False).decide(
+        dict(decider_events.history))
+
+    client = aio.MemoryClient()
+    current_decider = decider.DeciderWorker(
+        example, register=False, history_cache=history_cache)
+    current_decider.client = MagicMock()
+    token = client.add_decision_task(
+        current_decider.task_list, decider_events.history)
+
+    assert asyncio.run(aio.run_decider(current_decider, client, 'decider'))
+    assert client.decisions == [dict(taskToken=token, decisions=expected)]
+    assert not client.pages
+    assert not current_decider.client.poll_for_decision_task.called
+
+
+def test_run_decider_exception(monkeypatch):
+    """Test the decision errors are reported and the loop keeps running.
+    """
+
+    from tests.fixtures.flows import example
+
+    error = Exception('decide')
+    client = aio.MemoryClient()
+    current_decider = decider.DeciderWorker(example, register=False)
+    current_decider.on_exception = MagicMock()
+    monkeypatch.setattr(
+        decider.DeciderWorker, 'decide', MagicMock(side_effect=error))
+    client.add_decision_task(current_decider.task_list, dict(events=[]))
+
+    assert asyncio.run(aio.run_decider(current_decider, client))
+    current_decider.on_exception.assert_called_with(current_decider, error)
+    assert not client.decisions
+
+
+def test_serve_activities(monkeypatch):
+    """Test the activities of a flow are served by concurrent loops.
+    """
+
+    from tests.fixtures.flows import example
+
+    run = MagicMock(return_value=False)
+
+    async def run_activity(current_activity, client, **kwargs):
+        return run(current_activity.name)
+
+    monkeypatch.setattr(aio, 'run_activity', run_activity)
+    asyncio.run(aio.serve_activities(example, aio.MemoryClient(), pollers=2))
+
+    names = sorted(call[0][0] for call in run.call_args_list)
+    assert names == sorted(
+        current_activity.name
+        for current_activity in activity.find_workflow_activities(example)
+        for poller in range(2)
+        if not isinstance(current_activity, activity.ExternalActivity))
+
+
+def test_threaded_client(boto_client):
+    """Test the threaded client makes the boto calls in a thread pool.
+    """
+
+    boto_client.poll_for_activity_task.return_value = dict(activityId='id')
+    client = aio.ThreadedClient(boto_client)
+
+    resp = asyncio.run(client.poll_for_activity_task(
+        domain='domain', taskList=dict(name='list')))
+    assert resp == dict(activityId='id')
+    boto_client.poll_for_activity_task.assert_called_with(
+        domain='domain', taskList=dict(name='list'))
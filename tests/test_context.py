@@ -36,3 +36,30 @@ def test_get_workflow_execution_info(monkeypatch):
         'execution.domain': 'dev',
         'execution.run_id': '123abc=',
         'execution.workflow_id': 'test-workflow-id'}
+
+
+def test_add_result(monkeypatch):
+    """Test adding a decoded activity result.
+    """
+
+    current_context = context.ExecutionContext()
+    current_context.add_result(None)
+    assert not current_context.current
+
+    current_context.add_result({'k': 'v'})
+    assert current_context.current == {'k': 'v'}
+
+
+def test_context_fingerprint(monkeypatch):
+    """Test the fingerprint changes when the context is updated.
+    """
+
+    current_context = context.ExecutionContext()
+    fingerprint = current_context.fingerprint
+    assert current_context.fingerprint == fingerprint
+
+    current_context.add_result({})
+    assert current_context.fingerprint == fingerprint
+
+    current_context.add_result({'k': 'v'})
+    assert current_context.fingerprint != fingerprint
@@ -5,6 +5,8 @@ import pytest
 
 from garcon import decider
 from garcon import activity
+from garcon import event
+from garcon import utils
 from tests.fixtures import decider as decider_events
 
 
@@ -58,6 +60,35 @@ def test_get_history(monkeypatch):
         evt for evt in events if evt['eventType'].startswith('Decision')])
 
 
+def test_get_run_history(monkeypatch):
+    """Test the pages of events are folded as they arrive.
+    """
+
+    from tests.fixtures.flows import example
+
+    events = decider_events.history.get('events')
+    identity = 'identity'
+
+    d = decider.DeciderWorker(example, register=False)
+    d.client.poll_for_decision_task = MagicMock(
+        return_value={'events': events[14:]})
+
+    run_history = d.get_run_history(
+        identity, {'events': events[:14], 'nextPageToken': 'nextPage'})
+
+    d.client.poll_for_decision_task.assert_called_with(
+        domain=example.domain,
+        nextPageToken='nextPage',
+        identity=identity,
+        taskList=dict(name=d.task_list),
+        maximumPageSize=decider.MAXIMUM_PAGE_SIZE)
+    assert run_history.last_event_id == events[-1]['eventId']
+    assert run_history.context.current == {'k': 'v'}
+    assert (
+        set(run_history.activity_states) ==
+        set(event.activity_states_from_events(events)))
+
+
 def test_get_activity_states(monkeypatch):
     """Test get activity states from history.
     """
@@ -119,14 +150,16 @@ def test_running_workflow_identity(monkeypatch):
     d.client.poll_for_decision_task.assert_called_with(
         domain=d.domain,
         taskList=dict(name=d.task_list),
-        identity='')
+        identity='',
+        maximumPageSize=decider.MAXIMUM_PAGE_SIZE)
 
     # assert running decider with identity
     d.run('foo')
     d.client.poll_for_decision_task.assert_called_with(
         domain=d.domain,
         taskList=dict(name=d.task_list),
-        identity='foo')
+        identity='foo',
+        maximumPageSize=decider.MAXIMUM_PAGE_SIZE)
 
 
 def test_running_workflow_exception(monkeypatch):
@@ -375,3 +408,658 @@ def test_schedule_activity_task_with_custom_id(monkeypatch):
             scheduleToStartTimeout=str(instance.schedule_to_start),
             scheduleToCloseTimeout=str(instance.schedule_to_close)))
     assert expects in decisions
+
+
+def test_schedule_activity_task_with_priority(monkeypatch):
+    """Test the priority of an instance is the task priority.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.setattr(example.activity_1, 'priority', 3)
+    monkeypatch.setattr(
+        example.activity_1, 'generators',
+        [lambda context: [
+            {'index': 1, activity.PRIORITY_KEY: 10}, {'index': 2}]])
+
+    instances = list(example.activity_1.instances({}))
+    decisions = []
+    decider.schedule_activity_task(decisions, instances[0])
+    attributes = decisions[0]['scheduleActivityTaskDecisionAttributes']
+    assert attributes['taskPriority'] == '10'
+
+    decisions = []
+    decider.schedule_activity_tasks(decisions, instances)
+    assert [
+        decision['scheduleActivityTaskDecisionAttributes']['taskPriority']
+        for decision in decisions] == ['10', '3']
+
+
+def test_running_workflow_with_history_cache(monkeypatch):
+    """Test the decider only replays the new events of a cached run.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    events = decider_events.history.get('events')
+    workflow_execution = decider_events.history.get('workflowExecution')
+    cache = event.HistoryCache()
+    d = decider.DeciderWorker(example, register=False, history_cache=cache)
+    d.client.respond_decision_task_completed = MagicMock()
+    d.create_decisions_from_flow = MagicMock()
+
+    d.client.poll_for_decision_task = MagicMock(return_value=dict(
+        events=list(reversed(events[:14])),
+        workflowExecution=workflow_execution))
+    d.run()
+
+    d.client.poll_for_decision_task.assert_called_with(
+        domain=d.domain,
+        taskList=dict(name=d.task_list),
+        identity='',
+        maximumPageSize=decider.MAXIMUM_PAGE_SIZE,
+        reverseOrder=True)
+    run_history = cache.get(workflow_execution['runId'])
+    assert run_history.last_event_id == 14
+
+    # The second decision receives the newest events first, paging stops as
+    # soon as an event that has already been folded is found.
+    pages = [
+        dict(
+            events=list(reversed(events[20:])),
+            nextPageToken='page_2',
+            workflowExecution=workflow_execution),
+        dict(
+            events=list(reversed(events[10:20])),
+            nextPageToken='page_3',
+            workflowExecution=workflow_execution)]
+    d.client.poll_for_decision_task = MagicMock(side_effect=pages)
+    d.run()
+
+    assert d.client.poll_for_decision_task.call_count == 2
+    assert cache.get(workflow_execution['runId']) is run_history
+    assert run_history.last_event_id == events[-1]['eventId']
+    assert run_history.total_events == len(events)
+
+    activity_states, context = d.create_decisions_from_flow.call_args[0][1:]
+    assert activity_states is run_history.activity_states
+    assert context.current['k'] == 'v'
+
+
+def test_running_workflow_with_history_cache_closing(monkeypatch):
+    """Test closed runs are removed from the history cache.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    cache = event.HistoryCache()
+    d = decider.DeciderWorker(example, register=False, history_cache=cache)
+    d.client.respond_decision_task_completed = MagicMock()
+    d.client.poll_for_decision_task = MagicMock(
+        return_value=decider_events.history)
+
+    def complete(decisions, activity_states, context):
+        decisions.append(dict(decisionType='CompleteWorkflowExecution'))
+
+    d.create_decisions_from_flow = complete
+    d.run()
+
+    assert not len(cache)
+
+
+@pytest.mark.parametrize('decorated', [True, False])
+def test_schedule_activity_tasks(monkeypatch, boto_client, decorated):
+    """Test scheduling activity tasks in bulk.
+
+    The decisions are the same as the ones created one by one, the shared
+    part of the input is only encoded once.
+    """
+
+    from garcon import runner
+    from garcon import task
+
+    @task.decorate(timeout=10)
+    def task_a(value, index, missing):
+        pass
+
+    def task_b(context, activity=None):
+        pass
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(
+        name='activity',
+        generators=[lambda context: ({'index': i} for i in range(3))],
+        run=runner.Sync(
+            task_a.fill(value='value', index='index', missing='missing')
+            if decorated else task_b))
+
+    context = {
+        'value': 'shared', 'unused': 'value', 'index': 'overridden',
+        'execution.domain': 'domain', 'execution.run_id': 'run_id'}
+    instances = list(current_activity.instances(context))
+
+    dumps = MagicMock(side_effect=json.dumps)
+    monkeypatch.setattr(decider.json, 'dumps', dumps)
+    decisions = []
+    decider.schedule_activity_tasks(decisions, instances, version='2.0')
+    assert dumps.call_count == len(instances) + 1
+    monkeypatch.undo()
+
+    assert len(decisions) == len(instances)
+    for instance, decision in zip(instances, decisions):
+        expects = []
+        decider.schedule_activity_task(expects, instance, version='2.0')
+        attributes = decision['scheduleActivityTaskDecisionAttributes']
+        expected_attributes = expects[0][
+            'scheduleActivityTaskDecisionAttributes']
+
+        assert (
+            json.loads(attributes.pop('input')) ==
+            json.loads(expected_attributes.pop('input')))
+        assert attributes == expected_attributes
+        assert decision['decisionType'] == expects[0]['decisionType']
+
+
+def test_merge_json_objects():
+    """Test merging json objects.
+    """
+
+    assert decider.merge_json_objects('{}', '{}') == '{}'
+    assert decider.merge_json_objects('{"a": 1}', '{}') == '{"a": 1}'
+    assert decider.merge_json_objects('{}', '{"b": 2}') == '{"b": 2}'
+    assert json.loads(
+        decider.merge_json_objects('{"a": 1}', '{"b": 2}')) == dict(a=1, b=2)
+
+
+def test_running_workflow_without_scheduling_events(monkeypatch):
+    """Test the decider answers right away when nothing relevant happened.
+    """
+
+    from tests.fixtures.flows import example
+
+    events = decider_events.history.get('events')
+    d = decider.DeciderWorker(example, register=False)
+    d.client.respond_decision_task_completed = MagicMock()
+    d.get_run_history = MagicMock()
+
+    # Only the activity task started event (16) and the decision events have
+    # been recorded since the previous decision.
+    d.client.poll_for_decision_task = MagicMock(return_value=dict(
+        events=events[:18],
+        previousStartedEventId=15,
+        taskToken='token'))
+    d.run()
+
+    assert not d.get_run_history.called
+    d.client.respond_decision_task_completed.assert_called_with(
+        taskToken='token', decisions=[])
+
+
+def test_has_scheduling_events(monkeypatch):
+    """Test the detection of the events that can change the decisions.
+    """
+
+    from tests.fixtures.flows import example
+
+    events = decider_events.history.get('events')
+    d = decider.DeciderWorker(example, register=False)
+
+    # No previous decision.
+    assert d.has_scheduling_events(dict(events=events[:3]))
+
+    # An activity has completed since the previous decision.
+    assert d.has_scheduling_events(dict(
+        events=events[:19], previousStartedEventId=17))
+    assert not d.has_scheduling_events(dict(
+        events=events[:18], previousStartedEventId=17))
+
+    # More events are to be retrieved: without history cache, pages come in
+    # order and the new events are on the last pages.
+    assert d.has_scheduling_events(dict(
+        events=events[:18], previousStartedEventId=17,
+        nextPageToken='page'))
+
+    d.history_cache = event.HistoryCache()
+    assert not d.has_scheduling_events(dict(
+        events=list(reversed(events[12:18])), previousStartedEventId=17,
+        nextPageToken='page'))
+    assert d.has_scheduling_events(dict(
+        events=list(reversed(events[17:19])), previousStartedEventId=15,
+        nextPageToken='page'))
+
+
+def test_decider_pool_run(monkeypatch):
+    """Test a decider pool runs several pollers sharing the same decider.
+    """
+
+    from tests.fixtures.flows import example
+
+    pool = decider.DeciderPool(example, pollers=3, register=False)
+    monkeypatch.setattr(pool, 'run_once', MagicMock(return_value=False))
+    pool.run('identity')
+
+    assert pool.run_once.call_count == 3
+    pool.run_once.assert_called_with('identity')
+    assert pool.decider.compiled_flow.activities == pool.decider.activities
+
+
+def test_decider_pool_run_once(monkeypatch):
+    """Test a decider pool handles one decision task.
+    """
+
+    from tests.fixtures.flows import example
+
+    pool = decider.DeciderPool(example, register=False)
+    pool.decider.client.poll_for_decision_task = MagicMock(
+        return_value=decider_events.history)
+    pool.decider.client.respond_decision_task_completed = MagicMock()
+    pool.decider.decide = MagicMock(return_value=['decision'])
+
+    assert pool.run_once()
+    pool.decider.client.respond_decision_task_completed.assert_called_with(
+        taskToken=None, decisions=['decision'])
+
+    # Errors are reported, and the pool keeps running.
+    error = Exception('error')
+    pool.decider.decide.side_effect = error
+    pool.decider.on_exception = MagicMock()
+    assert pool.run_once()
+    pool.decider.on_exception.assert_called_with(pool.decider, error)
+
+
+def test_process_decider_pool(monkeypatch):
+    """Test the decisions of a process decider pool are made in processes.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+
+    with pytest.raises(ValueError):
+        decider.ProcessDeciderPool(object(), register=False)
+
+    pool = decider.ProcessDeciderPool(example, processes=2, register=False)
+    assert pool.decider.poll_options.get('reverseOrder')
+
+    try:
+        decisions = pool.decide(decider_events.history)
+    finally:
+        for executor in pool.executors:
+            executor.shutdown()
+
+    assert decisions == [dict(decisionType='CompleteWorkflowExecution')]
+    assert not decider.process_deciders
+
+
+def test_continue_as_new(monkeypatch):
+    """Test a long run is continued as new with its state.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    monkeypatch.setattr(example, 'continue_as_new_events', 10, raising=False)
+
+    d = decider.DeciderWorker(example, register=False)
+    events = decider_events.history.get('events')
+    decisions = d.decide(dict(decider_events.history, events=events[:22]))
+
+    assert len(decisions) == 1
+    assert decisions[0]['decisionType'] == 'ContinueAsNewWorkflowExecution'
+    attributes = decisions[0][
+        'continueAsNewWorkflowExecutionDecisionAttributes']
+    assert attributes['childPolicy'] == 'TERMINATE'
+    assert attributes['taskList'] == {'name': 'garcon_decider'}
+    assert attributes['workflowTypeVersion'] == '1.0'
+
+    # The new run only schedules the activity that was left.
+    start_event = dict(
+        events[0],
+        workflowExecutionStartedEventAttributes=dict(
+            events[0]['workflowExecutionStartedEventAttributes'],
+            input=attributes['input']))
+    decisions = d.decide(dict(
+        decider_events.history,
+        workflowExecution=dict(workflowId='test-workflow-id', runId='new'),
+        events=[start_event]))
+
+    assert [
+        decision['scheduleActivityTaskDecisionAttributes']['activityId']
+        for decision in decisions] == ['workflow_name_activity_4-1']
+    execution_input = json.loads(
+        decisions[0]['scheduleActivityTaskDecisionAttributes']['input'])
+    assert execution_input['k'] == 'v'
+    assert execution_input['execution.run_id'] == 'new'
+
+
+def test_continue_as_new_with_activities_in_flight(monkeypatch):
+    """Test a run is not continued as new while activities are in flight.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    monkeypatch.setattr(example, 'continue_as_new_events', 10, raising=False)
+
+    d = decider.DeciderWorker(example, register=False)
+    events = decider_events.history.get('events')
+    run_history = event.RunHistory()
+    run_history.add_events(events[:12])
+
+    assert d.continue_as_new(run_history) is None
+
+
+def test_continue_as_new_thresholds(monkeypatch):
+    """Test the thresholds used to continue a run as new.
+    """
+
+    from tests.fixtures.flows import example
+
+    events = decider_events.history.get('events')
+    run_history = event.RunHistory()
+    run_history.add_events(events[:22])
+
+    d = decider.DeciderWorker(example, register=False)
+    assert d.continue_as_new_events == decider.DEFAULT_CONTINUE_AS_NEW_EVENTS
+    assert d.continue_as_new(run_history) is None
+
+    d.continue_as_new_events = 0
+    assert d.continue_as_new(run_history) is None
+
+    d.continue_as_new_context_size = 5
+    assert d.continue_as_new(run_history)
+
+    # The state of the run needs to fit in the input of the new run.
+    monkeypatch.setattr(decider, 'MAXIMUM_INPUT_SIZE', 10)
+    assert d.continue_as_new(run_history) is None
+
+
+def shift_events(events, after, shift=1):
+    """Shift the ids of the events (and their references) after an id.
+    """
+
+    shifted = []
+    for original in events:
+        current = dict(original)
+        if current['eventId'] > after:
+            current['eventId'] += shift
+        for key, value in original.items():
+            if key.endswith('EventAttributes'):
+                current[key] = {
+                    name: (
+                        reference + shift
+                        if name.endswith('EventId') and reference and
+                        reference > after else reference)
+                    for name, reference in value.items()}
+        shifted.append(current)
+    return shifted
+
+
+def test_record_snapshot(monkeypatch):
+    """Test the snapshots of the run histories are recorded in markers.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    monkeypatch.setattr(example, 'snapshot_interval', 10, raising=False)
+
+    events = decider_events.history.get('events')
+    d = decider.DeciderWorker(
+        example, register=False, history_cache=event.HistoryCache())
+    decisions = d.decide(dict(decider_events.history, events=events[:12]))
+
+    assert len(decisions) == 1
+    assert decisions[0]['decisionType'] == 'RecordMarker'
+    attributes = decisions[0]['recordMarkerDecisionAttributes']
+    assert attributes['markerName'] == event.SNAPSHOT_MARKER
+
+    snapshot = event.find_snapshot([dict(
+        eventId=13, eventType='MarkerRecorded',
+        markerRecordedEventAttributes=attributes)])
+    assert snapshot['last_event_id'] == 12
+    assert set(snapshot['completed']) == {'workflow_name_activity_1'}
+    assert len(snapshot['scheduled']) == 2
+
+    # The next snapshot is recorded once the interval has passed.
+    run_history = d.history_cache.get(
+        decider_events.history['workflowExecution']['runId'])
+    assert run_history.snapshot_event_id == 12
+    decisions = d.decide(dict(decider_events.history, events=events[:20]))
+    assert not [
+        decision for decision in decisions
+        if decision['decisionType'] == 'RecordMarker']
+
+
+def test_get_run_history_from_snapshot(monkeypatch):
+    """Test a run that is not cached is replayed from its latest snapshot.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+
+    events = decider_events.history.get('events')
+    workflow_execution = decider_events.history.get('workflowExecution')
+
+    run_history = event.RunHistory()
+    run_history.add_events(events[:12])
+    snapshot = run_history.snapshot(activity.CompiledFlow(example).activities)
+    snapshot.update(last_event_id=12, start_attributes={})
+    marker = dict(
+        eventId=13, eventType='MarkerRecorded',
+        markerRecordedEventAttributes=dict(
+            markerName=event.SNAPSHOT_MARKER,
+            details=utils.compress(snapshot)))
+    history = events[:12] + [marker] + shift_events(events[12:22], 12)
+
+    expected = decider.DeciderWorker(example, register=False).decide(
+        dict(decider_events.history, events=history))
+
+    newest = list(reversed(history))
+    pages = [
+        dict(
+            events=newest[:5], nextPageToken='page_2',
+            workflowExecution=workflow_execution),
+        dict(
+            events=newest[5:10], nextPageToken='page_3',
+            workflowExecution=workflow_execution),
+        dict(
+            events=newest[10:15], nextPageToken='page_4',
+            workflowExecution=workflow_execution)]
+
+    d = decider.DeciderWorker(
+        example, register=False, history_cache=event.HistoryCache())
+    d.client.poll_for_decision_task = MagicMock(side_effect=pages[1:])
+    decisions = d.decide(pages[0])
+
+    assert decisions == expected
+    assert d.client.poll_for_decision_task.call_count == 2
+    run_history = d.history_cache.get(workflow_execution['runId'])
+    assert run_history.snapshot_event_id == 12
+    assert run_history.last_event_id == history[-1]['eventId']
+
+
+def test_schedule_budget(monkeypatch):
+    """Test the schedule budget limits the number and time of instances.
+    """
+
+    budget = decider.ScheduleBudget()
+    assert list(budget.limit(range(5))) == list(range(5))
+    assert not budget.exhausted
+
+    budget = decider.ScheduleBudget(count=5)
+    assert list(budget.limit(range(5))) == list(range(5))
+    assert not budget.exhausted
+
+    budget = decider.ScheduleBudget(count=3)
+    assert list(budget.limit(range(5))) == list(range(3))
+    assert budget.exhausted
+
+    monkeypatch.setattr(
+        decider.time, 'monotonic', MagicMock(side_effect=[0, 0, 1, 2, 3]))
+    budget = decider.ScheduleBudget(seconds=2)
+    assert list(budget.limit(range(5))) == list(range(2))
+    assert budget.exhausted
+
+
+def test_budgeted_scheduling(monkeypatch):
+    """Test large fan-outs are scheduled in chunks triggered by timers.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    monkeypatch.setattr(example, 'schedule_budget', 4, raising=False)
+    monkeypatch.setattr(
+        example.activity_1, 'generators',
+        [lambda context: ({'index': i} for i in range(10))])
+
+    d = decider.DeciderWorker(example, register=False)
+    events = decider_events.history.get('events')[:4]
+    scheduled = []
+
+    for chunk in [4, 4, 2]:
+        decisions = d.decide(dict(decider_events.history, events=events))
+        schedules = [
+            decision['scheduleActivityTaskDecisionAttributes']
+            for decision in decisions
+            if decision['decisionType'] == 'ScheduleActivityTask']
+        timers = [
+            decision['startTimerDecisionAttributes']
+            for decision in decisions
+            if decision['decisionType'] == 'StartTimer']
+
+        assert len(schedules) == chunk
+        assert len(timers) == (1 if chunk == 4 else 0)
+        scheduled += [attributes['activityId'] for attributes in schedules]
+
+        # The scheduled instances and the timer are recorded in the history.
+        for attributes in schedules:
+            events.append(dict(
+                eventId=len(events) + 1,
+                eventType='ActivityTaskScheduled',
+                activityTaskScheduledEventAttributes=attributes))
+        for attributes in timers:
+            assert attributes['startToFireTimeout'] == str(
+                decider.DEFAULT_SCHEDULE_TIMER)
+            events.append(dict(
+                eventId=len(events) + 1,
+                eventType='TimerFired',
+                timerFiredEventAttributes=dict(
+                    timerId=attributes['timerId'])))
+
+    assert len(set(scheduled)) == 10
+
+
+def test_schedule_with_max_in_flight(monkeypatch, boto_client):
+    """Test custom deciders schedule instances in a sliding window.
+    """
+
+    from garcon import runner
+
+    create = activity.create(boto_client, 'domain', 'flow')
+    current_activity = create(
+        name='activity',
+        generators=[lambda context: ({'index': i} for i in range(5))],
+        run=runner.Sync(lambda context, activity: None))
+
+    decisions = []
+    decider.schedule(
+        decisions, decider.ScheduleContext(), {}, {}, 'schedule_id',
+        current_activity, max_in_flight=2)
+    ids = [
+        decision['scheduleActivityTaskDecisionAttributes']['activityId']
+        for decision in decisions]
+    assert len(ids) == 2
+
+    # One instance has completed, the other one is still in flight: one more
+    # instance is scheduled.
+    completed = activity.ActivityState(ids[0])
+    completed.add_state(activity.ACTIVITY_SCHEDULED)
+    completed.add_state(activity.ACTIVITY_COMPLETED)
+    in_flight = activity.ActivityState(ids[1])
+    in_flight.add_state(activity.ACTIVITY_SCHEDULED)
+    history = {current_activity.name: {ids[0]: completed, ids[1]: in_flight}}
+
+    decisions = []
+    schedule_context = decider.ScheduleContext()
+    resp = decider.schedule(
+        decisions, schedule_context, history, {}, 'schedule_id',
+        current_activity, max_in_flight=2)
+    assert len(decisions) == 1
+    assert decisions[0]['scheduleActivityTaskDecisionAttributes'][
+        'activityId'] not in ids
+    assert not schedule_context.completed
+    assert resp.get_last_state() == activity.ACTIVITY_SCHEDULED
+
+
+def test_batched_scheduling(monkeypatch):
+    """Test the instances of a batched activity are scheduled in batches.
+    """
+
+    from tests.fixtures.flows import example
+
+    monkeypatch.delattr(example, 'decider', raising=False)
+    monkeypatch.setattr(example.activity_1, 'batch_size', 2)
+    monkeypatch.setattr(
+        example.activity_1, 'generators',
+        [lambda context: ({'index': i} for i in range(5))])
+
+    d = decider.DeciderWorker(example, register=False)
+    events = decider_events.history.get('events')[:4]
+    decisions = d.decide(dict(decider_events.history, events=events))
+
+    attributes = [
+        decision['scheduleActivityTaskDecisionAttributes']
+        for decision in decisions]
+    assert len(attributes) == 3
+
+    instances = {
+        instance.id: instance
+        for instance in example.activity_1.instances({})}
+    members = []
+    for batch in attributes[:2]:
+        ids = json.loads(batch['control'])[activity.BATCH_KEY]
+        execution_input = json.loads(batch['input'])
+        assert len(ids) == 2
+        assert [member[0] for member in execution_input[
+            activity.BATCH_KEY]] == ids
+        assert execution_input['execution.run_id'] == '123abc='
+        assert batch['startToCloseTimeout'] == str(
+            2 * instances[ids[0]].timeout)
+        members += ids
+
+    # The last instance is scheduled on its own.
+    assert 'control' not in attributes[2]
+    assert len(set(members + [attributes[2]['activityId']])) == 5
+
+    # The results of the batches are folded by instance.
+    for batch in attributes:
+        scheduled_id = len(events) + 1
+        events.append(dict(
+            eventId=scheduled_id,
+            eventType='ActivityTaskScheduled',
+            activityTaskScheduledEventAttributes=batch))
+
+        ids = [batch['activityId']]
+        if 'control' in batch:
+            ids = json.loads(batch['control'])[activity.BATCH_KEY]
+        result = {activity.BATCH_KEY: {
+            instance_id: {instance_id: True} for instance_id in ids}}
+        if 'control' not in batch:
+            result = {batch['activityId']: True}
+
+        events.append(dict(
+            eventId=scheduled_id + 1,
+            eventType='ActivityTaskCompleted',
+            activityTaskCompletedEventAttributes=dict(
+                scheduledEventId=scheduled_id, result=json.dumps(result))))
+
+    run_history = event.RunHistory()
+    run_history.add_events(events)
+    assert set(run_history.context.current) == set(instances)
+    assert activity.is_activity_completed(
+        example.activity_1, run_history.activity_states)
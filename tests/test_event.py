@@ -0,0 +1,350 @@
+from unittest.mock import MagicMock
+import json
+
+from garcon import activity
+from garcon import event
+from garcon import utils
+from tests.fixtures import decider as decider_events
+
+
+def test_run_history_fold():
+    """Test folding a list of events into a run history.
+    """
+
+    events = decider_events.history.get('events')
+    run_history = event.RunHistory()
+    run_history.add_events(events)
+
+    assert run_history.last_event_id == events[-1]['eventId']
+    assert run_history.total_events == len(events)
+    assert run_history.context.current == {'k': 'v'}
+    states = run_history.activity_states
+    for activity_name in ['activity_1', 'activity_2', 'activity_3']:
+        state = states['workflow_name_' + activity_name][
+            'workflow_name_' + activity_name + '-1']
+        assert state.get_last_state() == activity.ACTIVITY_COMPLETED
+
+
+def test_run_history_delta():
+    """Test folding events in several steps only processes new events.
+    """
+
+    events = decider_events.history.get('events')
+    run_history = event.RunHistory()
+    run_history.add_events(list(reversed(events[:14])))
+    assert run_history.last_event_id == 14
+    assert not run_history.context.current
+
+    # Events that have already been folded in are ignored.
+    run_history.add_events(events)
+    assert run_history.total_events == len(events)
+    assert run_history.context.current == {'k': 'v'}
+
+    state = run_history.activity_states['workflow_name_activity_1'][
+        'workflow_name_activity_1-1']
+    assert state.states == [
+        activity.ACTIVITY_SCHEDULED, activity.ACTIVITY_COMPLETED]
+
+
+def test_history_cache_lru():
+    """Test the least recently used runs are evicted first.
+    """
+
+    cache = event.HistoryCache(max_runs=2)
+    first, second, third = (
+        event.RunHistory(), event.RunHistory(), event.RunHistory())
+
+    cache.set('first', first)
+    cache.set('second', second)
+    assert cache.get('first') is first
+
+    cache.set('third', third)
+    assert len(cache) == 2
+    assert cache.get('second') is None
+    assert cache.get('first') is first
+    assert cache.get('third') is third
+
+    cache.remove('first')
+    assert cache.get('first') is None
+
+
+def test_history_cache_max_events():
+    """Test runs are evicted when the cache holds too many events.
+    """
+
+    events = decider_events.history.get('events')
+    cache = event.HistoryCache(max_events=len(events) + 4)
+
+    small = event.RunHistory()
+    small.add_events(events[:5])
+    cache.set('small', small)
+
+    large = event.RunHistory()
+    large.add_events(events)
+    cache.set('large', large)
+
+    assert cache.get('small') is None
+    assert cache.get('large') is large
+
+
+def test_run_history_decodes_results_once(monkeypatch):
+    """Test activity results are decoded once for the states and context.
+    """
+
+    calls = []
+    loads = event.json.loads
+
+    def counting_loads(value):
+        calls.append(value)
+        return loads(value)
+
+    monkeypatch.setattr(event.json, 'loads', counting_loads)
+
+    events = decider_events.history.get('events')
+    run_history = event.RunHistory()
+    run_history.add_events(events)
+
+    completed = [
+        e for e in events if e['eventType'] == 'ActivityTaskCompleted']
+    assert len(calls) == len(completed)
+
+    state = run_history.activity_states['workflow_name_activity_2'][
+        'workflow_name_activity_2-1']
+    assert state.result == {'k': 'v'}
+    assert run_history.context.current == {'k': 'v'}
+
+
+def test_sort_events():
+    """Test events are only sorted when they are not in order.
+    """
+
+    events = decider_events.history.get('events')
+    assert event.sort_events(events) is events
+
+    reversed_events = list(reversed(events))
+    sorted_events = event.sort_events(reversed_events)
+    assert sorted_events is not reversed_events
+    assert sorted_events == events
+
+
+def test_run_history_snapshot(monkeypatch):
+    """Test the snapshot of a run history is restored in a new history.
+    """
+
+    from tests.fixtures.flows import example
+
+    flow = activity.CompiledFlow(example)
+    events = decider_events.history.get('events')
+
+    run_history = event.RunHistory()
+    run_history.add_events(events[:12])
+    assert run_history.has_activities_in_flight()
+
+    run_history.add_events(events[:22])
+    assert not run_history.has_activities_in_flight()
+    run_history.context.set_workflow_execution_info(
+        decider_events.history, 'domain')
+
+    snapshot = run_history.snapshot(flow.activities)
+    assert snapshot == dict(
+        context={'k': 'v'},
+        workflow_input={},
+        completed={
+            'workflow_name_activity_1': True,
+            'workflow_name_activity_2': True,
+            'workflow_name_activity_3': True},
+        failures={},
+        scheduled={})
+
+    restored = event.RunHistory()
+    restored.restore(json.loads(json.dumps(snapshot)))
+    assert restored.context.current == {'k': 'v'}
+    assert not restored.has_activities_in_flight()
+    assert activity.is_activity_completed(
+        example.activity_2, restored.activity_states)
+    assert restored.activity_states['workflow_name_activity_1'].get(
+        'workflow_name_activity_1-1').get_last_state() == (
+            activity.ACTIVITY_COMPLETED)
+    assert restored.snapshot(flow.activities)['completed'] == (
+        snapshot['completed'])
+
+
+def test_run_history_snapshot_partial():
+    """Test the snapshot of partially completed and failed activities.
+    """
+
+    current_activity = MagicMock()
+    current_activity.name = 'activity'
+    current_activity.instances.return_value = [
+        MagicMock(id='activity-1'), MagicMock(id='activity-2'),
+        MagicMock(id='activity-3')]
+
+    completed = activity.ActivityState('activity-1')
+    completed.add_state(activity.ACTIVITY_SCHEDULED)
+    completed.add_state(activity.ACTIVITY_COMPLETED)
+    failed = activity.ActivityState('activity-2')
+    for failure in range(2):
+        failed.add_state(activity.ACTIVITY_SCHEDULED)
+        failed.add_state(activity.ACTIVITY_FAILED)
+
+    run_history = event.RunHistory()
+    run_history.activity_states['activity'] = {
+        'activity-1': completed, 'activity-2': failed}
+
+    snapshot = run_history.snapshot([current_activity])
+    assert snapshot['completed'] == {'activity': ['activity-1']}
+    assert snapshot['failures'] == {'activity': {'activity-2': 2}}
+
+    restored = event.RunHistory()
+    restored.restore(snapshot)
+    states = restored.activity_states['activity']
+    assert set(states) == {'activity-1', 'activity-2'}
+    assert states['activity-1'].ready
+    assert activity.count_activity_failures(states['activity-2']) == 2
+
+
+def test_run_history_continued_input():
+    """Test a run started with the state of a previous run restores it.
+    """
+
+    snapshot = dict(
+        context={'key': 'value'}, workflow_input={'key': 'input'},
+        completed={'activity': True}, failures={})
+
+    run_history = event.RunHistory()
+    run_history.add_events([dict(
+        eventId=1,
+        eventType='WorkflowExecutionStarted',
+        workflowExecutionStartedEventAttributes=dict(
+            childPolicy='TERMINATE',
+            input=json.dumps({
+                event.CONTINUED_STATE_KEY: utils.compress(snapshot)})))])
+
+    assert run_history.context.current == {'key': 'value'}
+    assert run_history.context.workflow_input == {'key': 'input'}
+    assert run_history.start_attributes['childPolicy'] == 'TERMINATE'
+    assert run_history.activity_states['activity'].get('any').ready
+
+
+def test_run_history_snapshot_in_flight():
+    """Test the activities in flight are part of the snapshot.
+    """
+
+    from tests.fixtures.flows import example
+
+    flow = activity.CompiledFlow(example)
+    events = decider_events.history.get('events')
+    run_history = event.RunHistory()
+    run_history.add_events(events[:12])
+
+    snapshot = run_history.snapshot(flow.activities)
+    assert snapshot['scheduled'] == {
+        11: ['workflow_name_activity_2', 'workflow_name_activity_2-1', 0],
+        12: ['workflow_name_activity_3', 'workflow_name_activity_3-1', 0]}
+
+    snapshot.update(last_event_id=12, start_attributes={'childPolicy': 'a'})
+    restored = event.RunHistory()
+    restored.restore(json.loads(json.dumps(snapshot)))
+    assert restored.last_event_id == 12
+    assert restored.snapshot_event_id == 12
+    assert restored.start_attributes == {'childPolicy': 'a'}
+    assert restored.has_activities_in_flight()
+
+    # The events that follow the snapshot are folded on top of it.
+    restored.add_events(events)
+    run_history.add_events(events)
+    assert restored.context.current == run_history.context.current
+    assert not restored.has_activities_in_flight()
+    assert restored.activity_states['workflow_name_activity_2'][
+        'workflow_name_activity_2-1'].result == {'k': 'v'}
+
+
+def test_find_snapshot():
+    """Test the latest snapshot marker is found.
+    """
+
+    def marker(event_id, name, details):
+        return dict(
+            eventId=event_id,
+            eventType='MarkerRecorded',
+            markerRecordedEventAttributes=dict(
+                markerName=name, details=utils.compress(details)))
+
+    assert event.find_snapshot(decider_events.history.get('events')) is None
+    assert event.find_snapshot([
+        marker(3, event.SNAPSHOT_MARKER, {'last_event_id': 2}),
+        marker(9, 'other', {'last_event_id': 8}),
+        marker(6, event.SNAPSHOT_MARKER, {'last_event_id': 5})]) == {
+            'last_event_id': 5}
+
+
+def batch_events(members, result=None):
+    """Create the events of a batch of instances.
+    """
+
+    events = [dict(
+        eventId=1,
+        eventType='ActivityTaskScheduled',
+        activityTaskScheduledEventAttributes=dict(
+            activityId='activity-batch-key',
+            activityType=dict(name='activity'),
+            control=json.dumps({activity.BATCH_KEY: members})))]
+
+    if result is not None:
+        events.append(dict(
+            eventId=2,
+            eventType='ActivityTaskCompleted',
+            activityTaskCompletedEventAttributes=dict(
+                scheduledEventId=1, result=json.dumps(result))))
+    return events
+
+
+def test_run_history_batch():
+    """Test the instances of a batch are folded one by one.
+    """
+
+    run_history = event.RunHistory()
+    run_history.add_events(batch_events(['a-1', 'a-2']))
+    states = run_history.activity_states['activity']
+    assert set(states) == {'a-1', 'a-2'}
+    assert activity.count_in_flight(states) == 2
+
+    run_history.add_events(batch_events(['a-1', 'a-2'], {
+        activity.BATCH_KEY: {'a-1': {'one': 1}, 'a-2': {'two': 2}},
+        activity.BATCH_DURATION_KEY: 3}))
+    assert states['a-1'].result == {'one': 1}
+    assert states['a-2'].result == {'two': 2}
+    assert states['a-2'].duration == 1.5
+    assert run_history.context.current == {'one': 1, 'two': 2}
+
+    run_history = event.RunHistory()
+    run_history.add_events(batch_events(['a-1', 'a-2']) + [dict(
+        eventId=2,
+        eventType='ActivityTaskFailed',
+        activityTaskFailedEventAttributes=dict(scheduledEventId=1))])
+    assert all(
+        states.get_last_state() == activity.ACTIVITY_FAILED
+        for states in run_history.activity_states['activity'].values())
+
+
+def test_run_history_snapshot_batch():
+    """Test the batches in flight are part of the snapshot.
+    """
+
+    current_activity = MagicMock()
+    current_activity.name = 'activity'
+    current_activity.instances.return_value = []
+
+    run_history = event.RunHistory()
+    run_history.add_events(batch_events(['a-1', 'a-2']))
+    snapshot = run_history.snapshot([current_activity])
+    assert snapshot['scheduled'] == {
+        1: ['activity', 'activity-batch-key', {'a-1': 0, 'a-2': 0}]}
+
+    snapshot.update(last_event_id=1)
+    restored = event.RunHistory()
+    restored.restore(json.loads(json.dumps(snapshot)))
+    restored.add_events(batch_events(['a-1', 'a-2'], {
+        activity.BATCH_KEY: {'a-1': {'one': 1}, 'a-2': {'two': 2}}}))
+    assert restored.context.current == {'one': 1, 'two': 2}
+    assert not restored.has_activities_in_flight()
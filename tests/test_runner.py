@@ -199,3 +199,114 @@ def test_runner_requirements_without_decoration():
 
     with pytest.raises(runner.NoRunnerRequirementsFound):
         current_runner.requirements(EMPTY_CONTEXT)
+
+
+def test_runner_describe():
+    """Test the description of a runner.
+    """
+
+    @task.decorate(timeout=10, heartbeat=4)
+    def task_a(value):
+        pass
+
+    @task.decorate(timeout=20)
+    def task_b():
+        pass
+
+    current_runner = runner.BaseRunner(
+        task_a.fill(value='context.value'), task_b.fill())
+    description = current_runner.describe(EMPTY_CONTEXT)
+
+    assert description == dict(
+        timeout=30, heartbeat=20, requirements={'context.value'})
+
+    # Without task lists, the description is calculated once.
+    assert current_runner.describe(EMPTY_CONTEXT) is description
+
+
+def test_runner_describe_with_task_list():
+    """Test a runner with task lists flattens them once per description.
+    """
+
+    @task.decorate(timeout=10)
+    def task_a(value):
+        pass
+
+    spy = MagicMock()
+
+    @task.list
+    def task_list(context):
+        spy()
+        for i in range(context.get('count')):
+            yield task_a.fill(value='context.value')
+
+    current_runner = runner.BaseRunner(task_list)
+    description = current_runner.describe(dict(count=3))
+
+    assert spy.call_count == 1
+    assert description.get('timeout') == 30
+    assert description.get('requirements') == {'context.value'}
+    assert current_runner.describe(dict(count=1)).get('timeout') == 10
+    assert spy.call_count == 2
+
+
+def test_external_runner_describe():
+    """Test the description of an external runner.
+    """
+
+    current_runner = runner.External(timeout=10)
+    assert current_runner.describe() == dict(
+        timeout=10, heartbeat=10, requirements=None)
+
+
+def test_synchronous_tasks_context_layers(monkeypatch, boto_client):
+    """Test the tasks of a Sync runner get a layered context.
+
+    The context takes precedence over the results of the previous tasks, and
+    values set by a task on its context are not seen by the next tasks.
+    """
+
+    monkeypatch.setattr(activity.ActivityExecution, 'heartbeat',
+        lambda self: None)
+
+    contexts = []
+
+    def task_a(context, activity=None):
+        context['written'] = True
+        return dict(foo='task_a', bar='task_a')
+
+    def task_b(context, activity=None):
+        contexts.append(dict(context))
+
+    current_runner = runner.Sync(task_a, task_b)
+    current_activity = activity.ActivityExecution(
+        boto_client, 'activityId', 'taskToken', '{}')
+    context = dict(foo='context')
+    current_runner.execute(current_activity, context)
+
+    assert contexts == [dict(foo='context', bar='task_a')]
+    assert context == dict(foo='context')
+
+
+def test_runner_resources():
+    """Test the resources of the tasks of a runner.
+    """
+
+    @task.decorate(resources=dict(cpu=1, memory_mb=512))
+    def small(context):
+        pass
+
+    @task.decorate(resources=dict(cpu=2, token=1))
+    def large(context):
+        pass
+
+    @task.decorate()
+    def undeclared(context):
+        pass
+
+    assert runner.Sync(small, large, undeclared).resources() == dict(
+        cpu=2, memory_mb=512, token=1)
+    assert runner.Async(
+        small, large, small, max_workers=2).resources() == dict(
+            cpu=3, memory_mb=1024, token=1)
+    assert runner.Sync(undeclared).resources() == dict()
@@ -6,6 +6,7 @@ from botocore import exceptions
 import datetime
 import pytest
 import json
+import types
 
 from garcon import utils
 
@@ -49,6 +50,15 @@ def test_create_dictionary_key():
         assert len(utils.create_dictionary_key(value)) == 40
 
 
+def test_create_dictionary_key_with_mapping():
+    """Test the key of a mapping matches the key of its dict.
+    """
+
+    value = dict(foo=10, bar='value')
+    assert utils.create_dictionary_key(
+        types.MappingProxyType(value)) == utils.create_dictionary_key(value)
+
+
 def test_non_throttle_error():
     """Assert SWF error is evaluated as non-throttle error properly.
     """
@@ -78,3 +88,48 @@ def test_throttle_backoff_handler():
         'Throttle Exception occurred on try {}. '
         'Sleeping for {} seconds'.format(
             details['tries'], details['wait']))
+
+
+def test_create_canonical_key():
+    """Test canonical keys are stable for nested values and unicode.
+    """
+
+    key = utils.create_canonical_key(
+        {'foo': {'b': 1, 'a': [1, 2]}, 'bar': 'café'})
+    assert len(key) == utils.CANONICAL_KEY_DIGEST_SIZE * 2
+    assert key == utils.create_canonical_key(
+        {'bar': 'café', 'foo': {'a': [1, 2], 'b': 1}})
+    assert key != utils.create_canonical_key(
+        {'bar': 'cafe', 'foo': {'a': [1, 2], 'b': 1}})
+    assert utils.create_canonical_key(dict(foo2=datetime.datetime.now()))
+
+    with pytest.raises(TypeError):
+        utils.create_canonical_key('something')
+
+    with pytest.raises(ValueError):
+        utils.create_canonical_key(dict())
+
+
+def test_create_canonical_keys():
+    """Test creating the canonical keys of many dictionaries at once.
+    """
+
+    dictionaries = [dict(index=i) for i in range(10)]
+    keys = utils.create_canonical_keys(dictionaries)
+
+    assert len(set(keys)) == len(dictionaries)
+    assert keys == [
+        utils.create_canonical_key(dictionary)
+        for dictionary in dictionaries]
+
+
+def test_compress():
+    """Test compressed values can be decompressed.
+    """
+
+    value = dict(key='value', values=list(range(100)), unicode='éè')
+    compressed = utils.compress(value)
+
+    assert isinstance(compressed, str)
+    assert len(compressed) < len(json.dumps(value))
+    assert utils.decompress(compressed) == value